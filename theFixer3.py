@@ -9,6 +9,20 @@ import argparse
 import ffmpy
 import json
 import datetime
+import threading
+import concurrent.futures
+import sqlite3
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import errno
+import contextlib
+import glob
+import hashlib
+import mmap
+import fcntl
 
 # Edit options here ##################################################
 outmode = 'mp4'                                                     #Extension of output file
@@ -17,8 +31,9 @@ remover = True                                                      #Delete orig
 accept_ext = '3gp flv mov mp4 mkv avi divx m4v mpeg mpg wmv ts'     #Extensions of video files to convert
 
 temp_path = u"/tmp"                                          #Directory for encode prior to moving back
+temp_same_filesystem = True                                 #Encode next to the output instead when temp_path is on another filesystem, so the move back is a rename
 mkvextract_exe = "/usr/bin/mkvextract"                               #Path to mkvextract executable
-atomicparsley_exe = "/usr/bin/AtomicParsley"                         #Path to AtomicParsley executable
+atomicparsley_exe = "/usr/bin/AtomicParsley"                         #Path to AtomicParsley executable, used if the title atoms cannot be edited in place
 mkvpropedit_exe = "/usr/bin/mkvpropedit"                             #Path to mkvpropedit executable
 
 strip_title = True                                          #Strip 'Title' field from metadata
@@ -30,9 +45,41 @@ crf = "18"                                                  #Default crf
 vbr = ""                                                    #Default audio vbr rate (CBR is used if this is blank)
 extract_subtitle = True                                     #Extract subtitles?
 subtitle_languages = "en eng english"                       #Codes for languages to extract
-threads = 0                                                 #Number of threads to use in ffmpeg, 0 defaults to all
+text_subtitles = "subrip ass ssa webvtt mov_text text"      #Subtitle codecs ffmpeg can write out as .srt
+threads = 0                                                 #Cores shared by all running ffmpeg jobs, 0 defaults to all
 additional_ffmpeg = '-preset slow -movflags +faststart'     #Default Additional flags for ffmpeg, preset sets speed and compression, movflags to make file web optimized
 deinterlace_ffmpeg = 'yadif'                                #Deinterlacing options
+renditions = ''                                             #Extra outputs made from the same decode as suffix:height:crf:preset, e.g. "480p:480:23:veryfast", blank fields keep the main output's
+detect_interlace = False                                    #Decide deinterlacing with the idet filter instead of trusting field_order
+idet_samples = 3                                            #Number of windows spread over the video to run idet on
+idet_frames = 200                                           #Frames idet looks at in each window
+jobs = 1                                                    #Number of files to encode at once
+probe_jobs = 2                                              #Number of files probed at once ahead of the encoders
+post_jobs = 2                                               #Number of finished encodes moved and post-processed at once
+lookahead = 4                                               #Files probed and waiting for an encoder
+remux_jobs = 4                                              #Number of files whose video is only copied (remux and audio-only jobs) run at once next to the encoders
+remux_threads = 2                                           #Threads given to each remux or audio-only job
+reads_per_device = 2                                        #Most jobs reading sources from the same disk at once, 0 for no limit
+min_free_space = 1000000000                                 #Bytes always left free on temp_path and the output disks
+space_margin = 1.2                                          #Headroom on the estimated output size reserved before a job starts
+segments = 0                                                #Split long encodes into this many parts encoded in parallel, 0 disables
+segment_min_duration = 1800                                 #Only split videos at least this many seconds long
+state_path = os.path.expanduser(u"~/.cache/theFixer")       #Directory for the probe cache and other saved state
+probe_cache_entries = 500000                                #Most files kept in the probe cache, 0 disables it
+fast_probe = True                                           #Probe only the fields used to make decisions, with a capped read size
+fast_probe_size = 1000000                                   #Bytes a fast probe may read before giving up, ffprobe's own default is 5000000
+fast_probe_duration = 1000000                               #Microseconds of the file a fast probe may analyse, ffprobe's own default is 5000000
+watch_settle = 5                                            #Seconds a new file must keep the same size before watch mode converts it
+metrics_log = ""                                            #File a JSON line of timings is appended to for every file it looked at, blank disables, None puts it in state_path
+metrics_textfile = ""                                       #Prometheus textfile collector file to keep batch totals in, blank disables
+progress_interval = 60                                      #Seconds between progress and ETA reports while encoding, 0 disables
+stall_timeout = 600                                         #Kill an ffmpeg whose output position has not moved for this many seconds, 0 disables
+stall_retries = 1                                           #Times a stalled encode is started again before the file is failed
+dedup = False                                               #Link the output of an identical source converted earlier instead of encoding it again
+dedup_samples = 64                                          #Blocks spread over the file that its content fingerprint hashes
+dedup_block = 65536                                         #Bytes in each sampled block
+target_speed = 0                                            #Realtime factor all encoders together must keep up, each file gets the slowest x264 preset measured to manage its share; 0 disables
+deadline = 0                                                #Hours each batch must be encoded in (not with watch mode), the whole batch is probed first and the speed needed is worked out again for every file; 0 disables
 
 ## END OPTIONS - DO NOT EDIT BELOW THIS LINE UNLESS YOU KNOW WHAT YOU ARE DOING ##
 
@@ -45,10 +92,96 @@ def decodeName(name):
     return name
     
 def move_without_copying_stat(src,dst):
-    old= shutil.copy2
-    shutil.copy2= shutil.copy
-    shutil.move(src,dst)
-    shutil.copy2= old
+    shutil.move(src, dst, copy_function=shutil.copy)
+
+def kernel_copy(fin, fout, size):
+    # copy_file_range lets the kernel (or a reflink-capable filesystem) move the data, sendfile
+    # at least keeps it out of userspace; plain reads are only the last resort. A copier that
+    # stops short (some filesystems make copy_file_range return 0) hands over to the next one.
+    copied = 0
+    for copier in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, copier):
+            continue
+        # sendfile writes at the destination's file position, copy_file_range is given both offsets
+        fout.seek(copied)
+        try:
+            while copied < size:
+                if copier == 'copy_file_range':
+                    count = os.copy_file_range(fin.fileno(), fout.fileno(), size - copied, copied, copied)
+                else:
+                    count = os.sendfile(fout.fileno(), fin.fileno(), copied, size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+        if copied == size:
+            return
+    fin.seek(copied)
+    fout.seek(copied)
+    shutil.copyfileobj(fin, fout)
+
+def commit_output(src, dst):
+    # Moves a finished encode into place with the cheapest method the two filesystems allow
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    if os.stat(src).st_dev == os.stat(dst_dir).st_dev:
+        os.replace(src, dst)
+        return
+    size = os.path.getsize(src)
+    free = shutil.disk_usage(dst_dir).free
+    if os.path.isfile(dst):
+        free += os.path.getsize(dst)
+    if free < size:
+        raise OSError(errno.ENOSPC, "Not enough space for " + str(size) + " bytes", dst_dir)
+    partial = os.path.join(dst_dir, '.' + os.path.basename(dst) + '.partial')
+    try:
+        with open(src, 'rb') as fin, open(partial, 'wb') as fout:
+            kernel_copy(fin, fout, size)
+            fout.flush()
+            if os.fstat(fout.fileno()).st_size != size:
+                raise OSError(errno.EIO, "Copied " + str(os.fstat(fout.fileno()).st_size) + " of " + str(size) + " bytes", dst)
+            os.fsync(fout.fileno())
+        os.replace(partial, dst)
+    except BaseException:
+        if os.path.isfile(partial):
+            os.remove(partial)
+        raise
+    os.remove(src)
+
+FICLONE = 0x40049409
+
+def content_fingerprint(filepath, samples, block):
+    # Size plus a hash of evenly spaced blocks. The file is read through mmap, so only the sampled pages come off the disk.
+    size = os.path.getsize(filepath)
+    digest = hashlib.blake2b(digest_size=16)
+    if size:
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_RANDOM)
+            if size <= samples * block:
+                digest.update(m)
+            else:
+                step = (size - block) // (samples - 1)
+                for i in range(samples):
+                    digest.update(m[i * step:i * step + block])
+    return '%d:%s' % (size, digest.hexdigest())
+
+def link_output(src, dst):
+    # Puts a copy-on-write clone of src at dst, or a hardlink where the filesystem cannot clone.
+    # Raises OSError when neither works, e.g. across filesystems. Returns how it was done.
+    partial = os.path.join(os.path.dirname(os.path.abspath(dst)), '.' + os.path.basename(dst) + '.partial')
+    try:
+        with open(src, 'rb') as fin, open(partial, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        how = 'reflinked'
+    except OSError:
+        if os.path.isfile(partial):
+            os.remove(partial)
+        os.link(src, partial)
+        how = 'hardlinked'
+    os.replace(partial, dst)
+    return how
                     
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
@@ -70,235 +203,2193 @@ class color:
    UNDERLINE = '\033[4m'
    END = '\033[0m'
 
-parser = argparse.ArgumentParser(description='Simple mp4 converter')
-parser.add_argument('-i','--input', help='Input file name/path', required=True)
-parser.add_argument('-m','--mode',help='Processing mode', choices=['quality', 'speed'], required=True)
-parser.add_argument('-f','--force', type=str2bool, nargs='?', const=True, default=False, help="Force reprocess")
-args = parser.parse_args()
-
-if args.mode == 'speed':
-    crf = "22"
-    additional_ffmpeg = '-preset superfast -movflags +faststart'
-
-if outmode == 'mp4':
-    outformat = 'mp4'
-elif outmode == 'mkv':
-    outformat = 'matroska'
-
-print("Validating FFMpeg configuration...\n")
-        
-format_resp = ffmpy.FFprobe(
-    inputs={'': None},
-    global_options=[
-        '-v', 'quiet',
-        '-formats', '2']
-).run(stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-
-if ('E mp4' in str(format_resp[0])) and ('E matroska' in str(format_resp[0])):
-    print("You have the suitable formats")
-else:
-    print("You do not have both the mkv and mp4 formats...Exiting!")
-    exit(1)
-
-codec_resp = ffmpy.FFprobe(
-    inputs={'': None},
-    global_options=[
-        '-v', 'quiet',
-        '-codecs', '2']
-).run(stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-
-if video_codec in str(codec_resp[0]):
-    print("Check " + video_codec + " Video Encoder ... OK")
-else:
-    print("Check " + video_codec + " Video Encoder ... NOK")
-    exit(1)
-
-if audio_codec in str(codec_resp[0]):
-    print("Check " + audio_codec + " Audio Encoder ... OK")
-else:
-    print("Check " + audio_codec + " Audio Encoder ... NOK")
-    exit(1)
-
-print("Your FFMpeg is OK!\n\nEntering File Processing...\n")
-
-subtitle_languages = subtitle_languages.lower()
-
-def process_file(path, file):
-    extension = decodeName(os.path.splitext(file)[1].replace(".", "").lower())
-    filename = decodeName(os.path.splitext(file)[0])
-
-    if extension in accept_ext and extension != "":
-        print(file + " is an acceptable extension. Checking file...")
+class JobOutput(object):
+    # Holds print output from worker threads until the file is finished,
+    # so logs of concurrent files come out in one block each.
+    installed = 0
+    install_lock = threading.Lock()
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def install(cls):
+        # Puts a JobOutput in front of sys.stdout, shared by every open Fixer until the last one is closed
+        with cls.install_lock:
+            if not isinstance(sys.stdout, JobOutput):
+                sys.stdout = JobOutput(sys.stdout)
+            cls.installed += 1
+            return sys.stdout
+
+    @classmethod
+    def uninstall(cls):
+        with cls.install_lock:
+            cls.installed -= 1
+            # Left alone if the host has put a stream of its own in front since
+            if cls.installed == 0 and isinstance(sys.stdout, JobOutput):
+                sys.stdout = sys.stdout.stream
+
+    def begin(self, buffer=None):
+        if buffer is None:
+            buffer = []
+        self.local.buffer = buffer
+
+    def detach(self):
+        # Hands the current buffer over to be continued by another thread with begin()
+        buffer = self.local.buffer
+        self.local.buffer = None
+        return buffer
+
+    def end(self):
+        buffer = getattr(self.local, 'buffer', None)
+        self.local.buffer = None
+        if buffer:
+            with self.lock:
+                self.stream.write(''.join(buffer))
+                self.stream.flush()
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            with self.lock:
+                self.stream.write(data)
+        else:
+            buffer.append(data)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def status(self, text):
+        # Written straight through, for live progress that should not wait for the file's log
+        with self.lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class StateDB(object):
+    # Small SQLite store for state kept between runs, shared by all worker threads.
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(os.path.join(directory, "state.db"), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.Lock()
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute(sql, params).fetchall()
+
+class ProbeCache(object):
+    # ffprobe results keyed on path, checked against size and mtime so an unchanged file costs one stat.
+    def __init__(self, db, max_entries):
+        self.db = db
+        self.max_entries = max_entries
+        self.db.execute('CREATE TABLE IF NOT EXISTS probe (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, used REAL, data TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS probe_used ON probe (used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS idet (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, interlaced INTEGER)')
+        self.entries = self.db.execute('SELECT COUNT(*) FROM probe')[0][0]
+
+    def get(self, filepath, st):
+        rows = self.db.execute('SELECT size, mtime_ns, data FROM probe WHERE path = ?', (filepath,))
+        if not rows or rows[0][0] != st.st_size or rows[0][1] != st.st_mtime_ns:
+            return None
+        self.db.execute('UPDATE probe SET used = ? WHERE path = ?', (time.time(), filepath))
+        return json.loads(rows[0][2])
+
+    def put(self, filepath, st, metaData):
+        # Rewriting a cached path, as remember_probe does on every sweep, is not a new entry
+        new = not self.db.execute('SELECT 1 FROM probe WHERE path = ?', (filepath,))
+        self.db.execute('INSERT OR REPLACE INTO probe (path, size, mtime_ns, used, data) VALUES (?, ?, ?, ?, ?)',
+                        (filepath, st.st_size, st.st_mtime_ns, time.time(), json.dumps(metaData)))
+        if new:
+            self.entries += 1
+        if self.entries > self.max_entries:
+            # Evict the least recently used tenth in one go rather than a row per insert
+            self.db.execute('DELETE FROM probe WHERE path IN (SELECT path FROM probe ORDER BY used LIMIT ?)',
+                            (self.entries - self.max_entries + self.max_entries // 10,))
+            self.db.execute('DELETE FROM idet WHERE path NOT IN (SELECT path FROM probe)')
+            self.entries = self.db.execute('SELECT COUNT(*) FROM probe')[0][0]
+
+    def get_interlaced(self, filepath, st):
+        rows = self.db.execute('SELECT size, mtime_ns, interlaced FROM idet WHERE path = ?', (filepath,))
+        if not rows or rows[0][0] != st.st_size or rows[0][1] != st.st_mtime_ns:
+            return None
+        return bool(rows[0][2])
+
+    def put_interlaced(self, filepath, st, interlaced):
+        self.db.execute('INSERT OR REPLACE INTO idet (path, size, mtime_ns, interlaced) VALUES (?, ?, ?, ?)',
+                        (filepath, st.st_size, st.st_mtime_ns, int(interlaced)))
+
+class SweepManifest(object):
+    # Directories whose files were all handled, with the directory mtime seen afterwards.
+    # A directory whose mtime is unchanged has no added, removed or renamed files, so its
+    # listing and probes can be skipped and only its recorded subdirectories are visited.
+    # Rows are kept per digest of the settings that decide what a file needs, so after a change
+    # of settings every directory is looked at again.
+    def __init__(self, db, settings):
+        self.db = db
+        self.settings = settings
+        # manifest had no settings in its key
+        self.db.execute('DROP TABLE IF EXISTS manifest')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sweep (path TEXT, settings TEXT, mtime_ns INTEGER, subdirs TEXT, results TEXT, PRIMARY KEY (path, settings))')
+
+    def unchanged_subdirs(self, path):
+        rows = self.db.execute('SELECT mtime_ns, subdirs, results FROM sweep WHERE path = ? AND settings = ?', (os.path.abspath(path), self.settings))
+        if not rows or rows[0][0] != os.stat(path).st_mtime_ns:
+            return None
+        if 'failed' in json.loads(rows[0][2]):
+            return None
+        return json.loads(rows[0][1])
+
+    def record(self, path, subdirs, results):
+        self.db.execute('INSERT OR REPLACE INTO sweep (path, settings, mtime_ns, subdirs, results) VALUES (?, ?, ?, ?, ?)',
+                        (os.path.abspath(path), self.settings, os.stat(path).st_mtime_ns, json.dumps(subdirs), json.dumps(results)))
+
+class SweepTracker(object):
+    # Counts the outstanding files of each listed directory and records it in the manifest once they are all done.
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.dirs = {}
+
+    def add_file(self, path):
+        with self.lock:
+            entry = self.dirs.setdefault(path, {'pending': 0, 'subdirs': None, 'results': {}})
+            entry['pending'] += 1
+
+    def listed(self, path, subdirs):
+        with self.lock:
+            entry = self.dirs.setdefault(path, {'pending': 0, 'subdirs': None, 'results': {}})
+            entry['subdirs'] = subdirs
+            done = entry['pending'] == 0
+        if done:
+            self.complete(path)
+
+    def finished(self, path, result):
+        with self.lock:
+            entry = self.dirs[path]
+            entry['pending'] -= 1
+            entry['results'][result] = entry['results'].get(result, 0) + 1
+            done = entry['pending'] == 0 and entry['subdirs'] is not None
+        if done:
+            self.complete(path)
+
+    def complete(self, path):
+        with self.lock:
+            entry = self.dirs.pop(path)
+        try:
+            self.manifest.record(path, entry['subdirs'], entry['results'])
+        except OSError:
+            pass
+
+class InotifyWatcher(object):
+    # Minimal inotify binding over libc, watching every directory of a tree.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def add_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            if '.noconvert' in filenames:
+                dirnames[:] = []
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath),
+                                             self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                print("Unable to watch " + dirpath + ": " + os.strerror(ctypes.get_errno()))
+                continue
+            self.paths[wd] = dirpath
+
+    def read_events(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0'))
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                print("Watch event queue overflowed, some new files were missed. Run without --watch to catch up.")
+                continue
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if wd in self.paths:
+                yield (self.paths[wd], name, mask)
+
+class ContentIndex(object):
+    # Outputs of converted sources keyed on the source's content fingerprint and the settings they were
+    # encoded with, so a copy of a source under another name can reuse the output instead of being encoded.
+    def __init__(self, db, settings):
+        self.db = db
+        self.settings = settings
+        self.db.execute('CREATE TABLE IF NOT EXISTS content (fingerprint TEXT, settings TEXT, outputs TEXT, PRIMARY KEY (fingerprint, settings))')
+        self.lock = threading.Lock()
+        # Fingerprints being encoded right now, an identical source waits for them instead of encoding too
+        self.pending = {}
+
+    def lookup(self, fingerprint):
+        # The recorded outputs as {rendition key: path}, '' being the main output, if they are all unchanged
+        rows = self.db.execute('SELECT outputs FROM content WHERE fingerprint = ? AND settings = ?', (fingerprint, self.settings))
+        if not rows:
+            return None
+        outputs = {}
+        for key, (filepath, size, mtime_ns) in json.loads(rows[0][0]).items():
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                return None
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return None
+            outputs[key] = filepath
+        return outputs
+
+    def claim(self, fingerprint):
+        # Returns the outputs of an identical source, waiting first if one is being encoded. None means
+        # the caller encodes it and must call finish() afterwards, whatever happens.
+        while True:
+            with self.lock:
+                event = self.pending.get(fingerprint)
+                if event is None:
+                    outputs = self.lookup(fingerprint)
+                    if outputs is None:
+                        self.pending[fingerprint] = threading.Event()
+                    return outputs
+            event.wait()
+
+    def finish(self, fingerprint, outputs=None):
+        # outputs is {rendition key: path} of a successful encode, None when it failed
+        with self.lock:
+            if outputs:
+                recorded = {}
+                for key, filepath in outputs.items():
+                    st = os.stat(filepath)
+                    recorded[key] = (filepath, st.st_size, st.st_mtime_ns)
+                self.db.execute('INSERT OR REPLACE INTO content (fingerprint, settings, outputs) VALUES (?, ?, ?)',
+                                (fingerprint, self.settings, json.dumps(recorded)))
+            event = self.pending.pop(fingerprint, None)
+        if event:
+            event.set()
+
+class JobJournal(object):
+    # Write-ahead record of how far each file of a batch got. Rows are written before each
+    # stage starts, so after a crash the next run knows which temp files are orphaned and
+    # which files were already finished. The batch is cleared once it completes.
+    STATES = ('queued', 'probing', 'encoding', 'moved', 'subtitles', 'done', 'failed')
+
+    def __init__(self, db, batch, keep_finished=True):
+        self.db = db
+        self.batch = os.path.abspath(batch)
+        self.keep_finished = keep_finished
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal (batch TEXT, path TEXT, state TEXT, temp TEXT, updated REAL, PRIMARY KEY (batch, path))')
+        self.previous = {}
+        self.lock = threading.Lock()
+        for path, state, temp in self.db.execute('SELECT path, state, temp FROM journal WHERE batch = ?', (self.batch,)):
+            self.previous[path] = (state, temp)
+
+    def recover(self):
+        if not self.previous:
+            return
+        finished = 0
+        for path, (state, temp) in self.previous.items():
+            if state in ('done', 'failed'):
+                finished += 1
+            elif temp:
+                if os.path.isfile(temp):
+                    print("Removing orphaned temp file " + temp)
+                    os.remove(temp)
+                if os.path.isdir(temp + '.segments'):
+                    print("Removing orphaned segments " + temp + '.segments')
+                    shutil.rmtree(temp + '.segments')
+                for rendition in glob.glob(glob.escape(temp) + '.*'):
+                    if os.path.isfile(rendition):
+                        print("Removing orphaned temp file " + rendition)
+                        os.remove(rendition)
+        print("Resuming earlier run of " + self.batch + ": " + str(finished) + " files finished, "
+              + str(len(self.previous) - finished) + " to redo\n")
+
+    def previous_state(self, filepath):
+        # Handed out once: a file of the same name that turns up later in a long-lived batch
+        # (watch mode) is a new file, not the one the earlier run left behind
+        with self.lock:
+            return self.previous.pop(os.path.abspath(filepath), (None, None))[0]
+
+    def unfinished(self):
+        return [path for path, (state, temp) in self.previous.items() if state not in ('done', 'failed')]
+
+    def set(self, filepath, state, temp=None):
+        filepath = os.path.abspath(filepath)
+        if state in ('done', 'failed') and not self.keep_finished:
+            self.db.execute('DELETE FROM journal WHERE batch = ? AND path = ?', (self.batch, filepath))
+            return
+        self.db.execute('INSERT OR REPLACE INTO journal (batch, path, state, temp, updated) VALUES (?, ?, ?, ?, ?)',
+                        (self.batch, filepath, state, temp, time.time()))
+
+    def clear(self):
+        self.db.execute('DELETE FROM journal WHERE batch = ?', (self.batch,))
+
+class Pipeline(object):
+    # Probe, encode and post-processing each run on their own pool, so the next files are probed
+    # and the last ones moved and tidied while the encoders are busy. A file's log follows it
+    # from stage to stage and is written out in one block when it leaves the pipeline.
+    def __init__(self, fixer, journal, on_done, hold=False):
+        self.fixer = fixer
+        self.journal = journal
+        self.on_done = on_done
+        # When holding, probed jobs are kept back until dispatch() sends them to the encoders in cost order
+        self.hold = hold
+        self.held = []
+        self.probing = 0
+        self.probe_pool = concurrent.futures.ThreadPoolExecutor(max_workers=fixer.config.probe_jobs)
+        self.encode_pool = concurrent.futures.ThreadPoolExecutor(max_workers=fixer.config.jobs)
+        # Jobs that only copy the video are bound by the disk, so they get their own wider pool
+        self.remux_pool = concurrent.futures.ThreadPoolExecutor(max_workers=fixer.config.remux_jobs)
+        self.post_pool = concurrent.futures.ThreadPoolExecutor(max_workers=fixer.config.post_jobs)
+        # Files between the start of probing and the end of encoding, which bounds the probe-ahead queue
+        self.ahead = threading.BoundedSemaphore(fixer.config.jobs + fixer.config.remux_jobs + fixer.config.lookahead)
+        self.pending = 0
+        self.submitted = 0
+        self.cond = threading.Condition()
+
+    def submit(self, path, file):
+        if not self.hold:
+            self.ahead.acquire()
+        with self.cond:
+            self.pending += 1
+            self.probing += 1
+            self.submitted += 1
+            seq = self.submitted
+        self.journal.set(os.path.join(path, file), 'queued')
+        self.probe_pool.submit(self.probe_stage, path, file, seq)
+
+    def probe_stage(self, path, file, seq):
+        self.fixer.job_output.begin()
+        metrics = FileMetrics()
+        try:
+            result, job = self.fixer.plan_file(path, file, self.journal, metrics)
+        except Exception as e:
+            print("Error processing " + file + ": %s" % e)
+            result, job = 'failed', None
+        with self.cond:
+            self.probing -= 1
+            self.cond.notify_all()
+        if job is None:
+            if not self.hold:
+                self.ahead.release()
+            self.done(path, file, result, metrics)
+            return
+        job['log'] = self.fixer.job_output.detach()
+        job['seq'] = seq
+        if self.hold:
+            with self.cond:
+                self.held.append(job)
+            return
+        self.encode(job)
+
+    def encode(self, job):
+        if job['remux']:
+            self.remux_pool.submit(self.encode_stage, job)
+        else:
+            # Lets the first encoders to start leave cores for the ones queued behind them
+            self.fixer.thread_budget.expect(1)
+            self.encode_pool.submit(self.encode_stage, job)
+
+    def dispatch(self, longest_first=None):
+        # longest_first None keeps the listing order
+        with self.cond:
+            while self.probing:
+                self.cond.wait()
+            if longest_first is None:
+                held = sorted(self.held, key=lambda job: job['seq'])
+            else:
+                held = sorted(self.held, key=job_cost, reverse=longest_first)
+            self.held = []
+        if held:
+            start = "in listing order" if longest_first is None else "with the " + ("longest" if longest_first else "shortest")
+            print("Planned " + str(len(held)) + " jobs, about " + str(datetime.timedelta(seconds=int(sum(job_cost(job) for job in held))))
+                  + " of 1080p encode work. Starting " + start + "...\n")
+        for job in held:
+            self.ahead.acquire()
+            self.encode(job)
+
+    def encode_stage(self, job):
+        self.fixer.job_output.begin(job['log'])
+        try:
+            result = self.fixer.encode_job(job)
+        except Exception as e:
+            print("Error processing " + job['file'] + ": %s" % e)
+            result = 'failed'
+        if not job['remux']:
+            self.fixer.thread_budget.expect(-1)
+        self.ahead.release()
+        if result:
+            self.done(job['path'], job['file'], result, job['metrics'], job)
+            return
+        job['log'] = self.fixer.job_output.detach()
+        self.post_pool.submit(self.post_stage, job)
+
+    def post_stage(self, job):
+        self.fixer.job_output.begin(job['log'])
+        try:
+            result = self.fixer.finish_job(job)
+        except Exception as e:
+            print("Error processing " + job['file'] + ": %s" % e)
+            result = 'failed'
+        self.done(job['path'], job['file'], result, job['metrics'], job)
+
+    def done(self, path, file, result, metrics, job=None):
+        self.fixer.job_output.end()
+        try:
+            # Every way out of the pipeline finishes the file's row, or ignored files and crashed
+            # stages would stay queued and be picked up again by every restart
+            self.journal.set(os.path.join(path, file), 'failed' if result in ('failed', 'probe_fail') else 'done')
+            if job is not None:
+                self.fixer.release_job(job)
+            result = FileResult(path, file, result, job, metrics)
+            self.fixer.record(result)
+            self.on_done(result)
+        finally:
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+        for pool in (self.probe_pool, self.encode_pool, self.remux_pool, self.post_pool):
+            pool.shutdown()
+
+class CapabilityCache(object):
+    # ffprobe -formats / -codecs listings, kept per ffprobe binary and only fetched again after it changes.
+    # Checks run the first time an encode needs them instead of on every start.
+    def __init__(self, db):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS capability (binary TEXT, mtime_ns INTEGER, kind TEXT, listing TEXT, PRIMARY KEY (binary, kind))')
+        self.lock = threading.Lock()
+        self.checked = {}
+
+    def listing(self, kind):
+        with self.lock:
+            if kind in self.checked:
+                return self.checked[kind]
+            binary = os.path.realpath(shutil.which('ffprobe') or 'ffprobe')
+            mtime_ns = os.stat(binary).st_mtime_ns if os.path.exists(binary) else 0
+            rows = self.db.execute('SELECT mtime_ns, listing FROM capability WHERE binary = ? AND kind = ?', (binary, kind))
+            if rows and rows[0][0] == mtime_ns:
+                listing = rows[0][1]
+            else:
+                resp = ffmpy.FFprobe(
+                    inputs={'': None},
+                    global_options=[
+                        '-v', 'quiet',
+                        kind, '2']
+                ).run(stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+                listing = str(resp[0])
+                self.db.execute('INSERT OR REPLACE INTO capability (binary, mtime_ns, kind, listing) VALUES (?, ?, ?, ?)',
+                                (binary, mtime_ns, kind, listing))
+            self.checked[kind] = listing
+            return listing
+
+    def require_format(self, name):
+        if 'E ' + name not in self.listing('-formats'):
+            raise RuntimeError("Your FFMpeg cannot write the " + name + " format")
+
+    def require_encoder(self, name, label):
+        if name not in self.listing('-codecs'):
+            print("Check " + name + " " + label + " Encoder ... NOK")
+            raise RuntimeError("Your FFMpeg does not have the " + name + " encoder")
+
+class ThreadBudget(object):
+    # Splits a fixed number of cores between the ffmpeg jobs running at the same time. Every job gets
+    # an even share (total // jobs); a heavy file may add cores on top only while no other encode is
+    # waiting to start that would need them.
+    def __init__(self, total, jobs):
+        self.total = total
+        self.jobs = jobs
+        self.per_job = max(1, total // jobs)
+        self.free = total
+        self.running = 0
+        # Encodes handed to the encoders and not finished yet, running or about to start
+        self.expected = 0
+        self.cond = threading.Condition()
+
+    def share(self, weight):
+        if self.jobs == 1:
+            return self.total
+        return max(self.per_job, min(self.total, int(round(self.per_job * weight))))
+
+    def expect(self, change):
+        with self.cond:
+            self.expected += change
+
+    def acquire(self, count):
+        # The even share is always given, even if a job started alone took more and the cores are
+        # briefly oversubscribed, so nothing waits behind a long encode. Cores beyond it come only out
+        # of those left after the even shares, split with the encodes still to start.
+        with self.cond:
+            starting = max(0, min(self.jobs, self.expected) - self.running - 1)
+            idle = self.free - self.per_job - starting * self.per_job
+            count = min(count, self.per_job + max(0, idle) // (starting + 1))
+            self.free -= count
+            self.running += 1
+        return count
+
+    def release(self, count):
+        with self.cond:
+            self.free += count
+            self.running -= 1
+
+class SpeedTable(object):
+    # Realtime factors measured for each x264 preset, per source codec and height bucket, so a preset
+    # can be picked for the speed a file needs before encoding it.
+    def __init__(self, db):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS speed (codec TEXT, height INTEGER, preset TEXT, factor REAL, samples INTEGER, PRIMARY KEY (codec, height, preset))')
+        self.lock = threading.Lock()
+
+    def record(self, codec, height, preset, factor):
+        if preset not in X264_PRESET_SPEED:
+            return
+        with self.lock:
+            rows = self.db.execute('SELECT factor, samples FROM speed WHERE codec = ? AND height = ? AND preset = ?', (codec, height, preset))
+            samples = 1
+            if rows:
+                # A running mean that still follows the machine when it gets busier or faster
+                old, samples = rows[0]
+                factor = old + (factor - old) * max(1.0 / (samples + 1), 0.2)
+                samples += 1
+            self.db.execute('INSERT OR REPLACE INTO speed (codec, height, preset, factor, samples) VALUES (?, ?, ?, ?, ?)',
+                            (codec, height, preset, factor, samples))
+
+    def estimate(self, codec, height, preset):
+        # The measured factor, or one carried over from the presets that were measured, preferring the same
+        # source codec over others of the same height. None until something of that height was encoded.
+        rows = self.db.execute('SELECT codec, preset, factor, samples FROM speed WHERE height = ?', (height,))
+        rows = [row for row in rows if row[0] == codec] or rows
+        exact = [(factor, samples) for row_codec, row_preset, factor, samples in rows if row_preset == preset]
+        if not exact:
+            exact = [(factor * X264_PRESET_SPEED[preset] / X264_PRESET_SPEED[row_preset], samples)
+                     for row_codec, row_preset, factor, samples in rows if row_preset in X264_PRESET_SPEED]
+        if not exact:
+            return None
+        return sum(factor * samples for factor, samples in exact) / sum(samples for factor, samples in exact)
+
+class SpaceReservations(object):
+    # Disk space promised to running jobs, per device. A job starts only once its estimated output fits
+    # next to what is promised to the others, so a full disk shows up before the encode and not hours into it.
+    # A reservation shrinks as its file grows, since the file's own size already comes off the free space.
+    def __init__(self, min_free):
+        self.min_free = min_free
+        self.cond = threading.Condition()
+        self.held = []
+
+    def outstanding(self, dev):
+        total = 0
+        for held_dev, path, size in self.held:
+            if held_dev == dev:
+                try:
+                    total += max(0, size - os.path.getsize(path))
+                except OSError:
+                    total += size
+        return total
+
+    def reserve(self, claims):
+        # claims are (path of the file to be written, estimated bytes); returns the reservation to release
+        needs = {}
+        entries = []
+        for path, size in claims:
+            directory = os.path.dirname(os.path.abspath(path))
+            dev = os.stat(directory).st_dev
+            needs[dev] = (directory, needs.get(dev, (directory, 0))[1] + size)
+            entries.append((dev, path, size))
+        waiting = False
+        with self.cond:
+            while True:
+                short = None
+                for dev, (directory, size) in needs.items():
+                    free = shutil.disk_usage(directory).free - self.min_free - self.outstanding(dev)
+                    if free < size:
+                        short = (dev, directory, size, free)
+                        break
+                if short is None:
+                    self.held.extend(entries)
+                    return entries
+                dev, directory, size, free = short
+                if not any(held_dev == dev for held_dev, path, held_size in self.held):
+                    # Nothing running will give space back
+                    raise OSError(errno.ENOSPC, "Needs about " + str(size // 1000000) + " MB but only "
+                                  + str(max(0, free) // 1000000) + " MB can be used", directory)
+                if not waiting:
+                    print("Waiting for about " + str(size // 1000000) + " MB to be free on " + directory + "...")
+                    waiting = True
+                self.cond.wait(30)
+
+    def release(self, entries):
+        if not entries:
+            return
+        with self.cond:
+            for entry in entries:
+                if entry in self.held:
+                    self.held.remove(entry)
+            self.cond.notify_all()
+
+class DeviceReads(object):
+    # Caps the jobs reading from one source device at once, so a spinning disk or NAS share
+    # streams a few files instead of seeking between many.
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def acquire(self, path):
+        if not self.limit:
+            return None
+        dev = os.stat(path).st_dev
+        with self.lock:
+            slot = self.slots.setdefault(dev, threading.Semaphore(self.limit))
+        slot.acquire()
+        return slot
+
+    def release(self, slot):
+        if slot is not None:
+            slot.release()
+
+class FileMetrics(object):
+    # Wall time of each stage a file went through, with the sizes and codec decision needed to judge its throughput.
+    STAGES = ('probe', 'encode', 'move', 'title_strip', 'subtitles', 'delete')
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.duration = None
+        self.vcodec = None
+        self.acodec = None
+        self.preset = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - start
+
+    def speed(self):
+        # Seconds of video encoded per second, the same figure ffmpeg shows as speed=
+        if not self.duration or not self.stages.get('encode'):
+            return None
+        return self.duration / self.stages['encode']
+
+class MetricsSink(object):
+    # Appends a JSON line per finished file and keeps running totals in a Prometheus textfile.
+    def __init__(self, log_path, textfile_path):
+        self.log_path = log_path
+        self.textfile_path = textfile_path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.stage_seconds = dict((name, 0.0) for name in FileMetrics.STAGES)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encoded_seconds = 0.0
+        self.last_speed = None
+
+    def record(self, result):
+        metrics = result.metrics
+        entry = {
+            'time': datetime.datetime.now().isoformat(),
+            'source': os.path.abspath(result.source),
+            'status': result.status,
+            'output': result.output and os.path.abspath(result.output),
+            'vcodec': metrics.vcodec,
+            'acodec': metrics.acodec,
+            'preset': metrics.preset,
+            'bytes_in': metrics.bytes_in,
+            'bytes_out': metrics.bytes_out,
+            'duration': metrics.duration,
+            'speed': metrics.speed(),
+            'wall': time.time() - metrics.started,
+            'stages': metrics.stages,
+        }
+        with self.lock:
+            # Files with an extension it does not handle (.nfo, .srt, ...) would only make the log grow on every sweep
+            if self.log_path and result.status != 'ignored':
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            self.files[result.status] = self.files.get(result.status, 0) + 1
+            for name, seconds in metrics.stages.items():
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+            self.bytes_in += metrics.bytes_in
+            self.bytes_out += metrics.bytes_out
+            if entry['speed'] is not None:
+                self.encoded_seconds += metrics.duration
+                self.last_speed = entry['speed']
+            if self.textfile_path:
+                self.write_textfile()
+
+    def write_textfile(self):
+        lines = ['# HELP thefixer_files_total Files handled, by result.', '# TYPE thefixer_files_total counter']
+        for status, count in sorted(self.files.items()):
+            lines.append('thefixer_files_total{status="%s"} %d' % (status, count))
+        lines += ['# HELP thefixer_stage_seconds_total Wall time spent in each stage.', '# TYPE thefixer_stage_seconds_total counter']
+        for name, seconds in sorted(self.stage_seconds.items()):
+            lines.append('thefixer_stage_seconds_total{stage="%s"} %.3f' % (name, seconds))
+        lines += ['# HELP thefixer_bytes_read_total Size of the source files handled.', '# TYPE thefixer_bytes_read_total counter',
+                  'thefixer_bytes_read_total %d' % self.bytes_in,
+                  '# HELP thefixer_bytes_written_total Size of the outputs written.', '# TYPE thefixer_bytes_written_total counter',
+                  'thefixer_bytes_written_total %d' % self.bytes_out,
+                  '# HELP thefixer_encoded_seconds_total Seconds of video encoded.', '# TYPE thefixer_encoded_seconds_total counter',
+                  'thefixer_encoded_seconds_total %.3f' % self.encoded_seconds]
+        if self.last_speed is not None:
+            lines += ['# HELP thefixer_last_speed Realtime factor of the last encode.', '# TYPE thefixer_last_speed gauge',
+                      'thefixer_last_speed %.3f' % self.last_speed]
+        # The collector may read at any moment, so the file is replaced whole
+        partial = self.textfile_path + '.partial'
+        with open(partial, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(partial, self.textfile_path)
+
+class EncodeStalled(Exception):
+    pass
+
+class SegmentsDrifted(Exception):
+    pass
+
+class ProgressBoard(object):
+    # Latest ffmpeg -progress figures of the files in the batch, from which the per-job and batch ETAs are worked out.
+    def __init__(self, output, interval):
+        self.output = output
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.last_report = time.monotonic()
+
+    def add(self, key, duration, encodes=True):
+        # encodes is False for files whose video is only copied
+        with self.lock:
+            self.jobs[key] = {'duration': duration or 0.0, 'out_time': 0.0, 'started': None, 'progress': {}, 'encodes': encodes}
+
+    def remove(self, key):
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    def update(self, key, out_time, progress):
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                return
+            if job['started'] is None or out_time < job['out_time']:
+                # First report, or the encode was started over
+                job['started'] = time.monotonic()
+            job['out_time'] = out_time
+            job['progress'] = progress
+            if not self.interval or time.monotonic() - self.last_report < self.interval:
+                return
+            self.last_report = time.monotonic()
+            lines = [self.describe(name, job) for name, job in sorted(self.jobs.items()) if job['started'] is not None]
+            lines.append(self.describe_batch())
+        self.output.status('\n'.join(lines) + '\n')
+
+    def speed(self, job):
+        # Seconds of video per second, from ffmpeg's own figure when it gives one
+        reported = job['progress'].get('speed', '').rstrip('x')
+        try:
+            return float(reported)
+        except ValueError:
+            elapsed = time.monotonic() - job['started']
+            return job['out_time'] / elapsed if elapsed > 0 else 0.0
+
+    def describe(self, name, job):
+        speed = self.speed(job)
+        text = os.path.basename(name) + ": " + str(datetime.timedelta(seconds=int(job['out_time'])))
+        if job['duration']:
+            text += " of " + str(datetime.timedelta(seconds=int(job['duration']))) + " (%d%%)" % (100 * job['out_time'] / job['duration'])
+        text += " fps=" + job['progress'].get('fps', '?') + " bitrate=" + job['progress'].get('bitrate', '?') + " speed=%.2fx" % speed
+        if job['duration'] and speed > 0:
+            text += " ETA " + str(datetime.timedelta(seconds=int((job['duration'] - job['out_time']) / speed)))
+        return text
+
+    def position(self, key):
+        # Seconds into the file the latest progress report got to
+        with self.lock:
+            return self.jobs.get(key, {}).get('out_time', 0.0)
+
+    def encode_backlog(self):
+        # Seconds of video the encoders still have to get through
+        with self.lock:
+            return sum(max(0.0, job['duration'] - job['out_time']) for job in self.jobs.values() if job['encodes'])
+
+    def describe_batch(self):
+        running = [job for job in self.jobs.values() if job['started'] is not None]
+        remaining = sum(max(0.0, job['duration'] - job['out_time']) for job in self.jobs.values())
+        throughput = sum(self.speed(job) for job in running)
+        text = "Batch: " + str(len(running)) + " encoding, " + str(len(self.jobs) - len(running)) + " waiting"
+        if throughput > 0:
+            text += ", ETA " + str(datetime.timedelta(seconds=int(remaining / throughput)))
+        return text
+
+def encode_weight(metaData):
+    # Relative cost of a re-encode compared to an hour of 1080p, used to size its thread share
+    pixels = 1920 * 1080
+    for vs in metaData["streams"]:
+        if vs.get("codec_type") == "video" and vs.get("width") and vs.get("height"):
+            pixels = int(vs["width"]) * int(vs["height"])
+            break
+    try:
+        duration = float(metaData["format"]["duration"])
+    except (KeyError, ValueError):
+        duration = 3600.0
+    size_weight = min(max(pixels / (1920.0 * 1080.0), 0.25), 2.0)
+    time_weight = min(max(duration / 3600.0, 0.5), 2.0)
+    return size_weight * time_weight
+
+def probe_complete(metaData):
+    # True when a probe has every field the codec decisions below rely on
+    if "duration" not in metaData.get("format", {}) or not metaData.get("streams"):
+        return False
+    for vs in metaData["streams"]:
+        if "codec_type" not in vs:
+            return False
+        if vs["codec_type"] in ("video", "audio", "subtitle") and "codec_name" not in vs:
+            return False
+        if vs["codec_type"] == "video" and not vs.get("width"):
+            # The capped read ended before the first frame was parsed
+            return False
+    return True
+
+def mp4_atoms(f, start, end):
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            large = f.read(8)
+            if len(large) < 8 or pos + 16 > end:
+                raise ValueError("Truncated atom header at offset " + str(pos))
+            size = struct.unpack('>Q', large)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError("Bad atom size at offset " + str(pos))
+        yield kind, pos, size, header
+        pos += size
+
+def strip_mp4_title(filepath):
+    # Turns the title and comment atoms under moov/udta into 'free' atoms in place.
+    # Only the four type bytes of each atom are rewritten, the rest of the file is not read.
+    stripped = 0
+    with open(filepath, 'r+b') as f:
+        end = os.fstat(f.fileno()).st_size
+        for kind, pos, size, header in mp4_atoms(f, 0, end):
+            if kind != b'moov':
+                continue
+            for kind, pos, size, header in mp4_atoms(f, pos + header, pos + size):
+                if kind != b'udta':
+                    continue
+                targets = []
+                for kind, pos, size, header in mp4_atoms(f, pos + header, pos + size):
+                    if kind in (b'\xa9nam', b'\xa9cmt'):
+                        targets.append(pos)
+                    elif kind == b'meta':
+                        # meta is a full box, its children start after 4 bytes of version and flags
+                        for kind, pos, size, header in mp4_atoms(f, pos + header + 4, pos + size):
+                            if kind == b'ilst':
+                                for kind, pos, size, header in mp4_atoms(f, pos + header, pos + size):
+                                    if kind in (b'\xa9nam', b'\xa9cmt'):
+                                        targets.append(pos)
+                for pos in targets:
+                    f.seek(pos + 4)
+                    f.write(b'free')
+                    stripped += 1
+    return stripped
+
+def has_audio(metaData):
+    return any(vs.get("codec_type") == "audio" for vs in metaData["streams"])
+
+class Rendition(object):
+    # An extra output encoded from the same decode as the main one, written as <name>.<suffix>.<outmode>.
+    # height scales it down (never up), crf and preset replace the main output's when set.
+    def __init__(self, suffix, height=None, crf=None, preset=None):
+        if not suffix or os.sep in suffix:
+            raise ValueError("A rendition needs a suffix usable in a file name")
+        self.suffix = suffix
+        self.height = height
+        self.crf = crf
+        self.preset = preset
+
+    @classmethod
+    def parse(cls, text):
+        fields = (text.split(':') + [''] * 4)[:4]
+        try:
+            height = int(fields[1]) if fields[1] else None
+        except ValueError:
+            raise ValueError("Rendition height must be a number: " + text)
+        return cls(fields[0], height, fields[2] or None, fields[3] or None)
+
+    def __repr__(self):
+        return 'Rendition(%r, %r, %r, %r)' % (self.suffix, self.height, self.crf, self.preset)
+
+def with_preset(args, preset):
+    # additional_ffmpeg split into a list, with its -preset swapped for another one
+    args = list(args)
+    if '-preset' in args and args.index('-preset') + 1 < len(args):
+        args[args.index('-preset') + 1] = preset
     else:
-        print(file + " is not an acceptable extension. Skipping...")
-        return
+        args.extend(['-preset', preset])
+    return args
+
+# x264 presets from fastest to slowest, with a rough speed relative to medium to carry a measured speed over to the others
+X264_PRESETS = (('ultrafast', 6.0), ('superfast', 4.5), ('veryfast', 3.0), ('faster', 1.8), ('fast', 1.3),
+                ('medium', 1.0), ('slow', 0.6), ('slower', 0.3), ('veryslow', 0.15))
+X264_PRESET_SPEED = dict(X264_PRESETS)
+
+def preset_of(args):
+    # The -preset in a list of ffmpeg args, x264's default when there is none
+    if '-preset' in args and args.index('-preset') + 1 < len(args):
+        return args[args.index('-preset') + 1]
+    return 'medium'
+
+def speed_bucket(metaData):
+    # Source codec and height rounded up to a common frame size, which is what encode speed is kept per
+    video = main_video_index(metaData)
+    for vs in metaData["streams"]:
+        if vs["index"] == video:
+            height = int(vs.get("height") or 0)
+            for bucket in (480, 576, 720, 1080, 1440, 2160):
+                if height <= bucket:
+                    return vs["codec_name"], bucket
+            return vs["codec_name"], 4320
+    return None, 0
 
-    print('Processing Started: {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()))
+def estimate_output_size(metaData, source_size):
+    # A converted file is rarely bigger than its source, so the source bitrate over the duration is the estimate
+    fmt = metaData.get("format", {})
     try:
+        return int(float(fmt["bit_rate"]) * float(fmt["duration"]) / 8)
+    except (KeyError, ValueError):
+        return source_size
+
+def is_cover(vs):
+    # Cover art shows up as a video stream holding a single picture
+    return vs.get("codec_name") in ('mjpeg', 'png', 'bmp') or vs.get("disposition", {}).get("attached_pic") == 1
+
+def main_video_index(metaData):
+    # The stream ffmpeg would pick by default, skipping cover art
+    for vs in metaData["streams"]:
+        if vs.get("codec_type") == "video" and not is_cover(vs):
+            return vs["index"]
+    return None
+
+def progress_seconds(progress):
+    # out_time_ms is in microseconds as well, older ffmpeg only sends that one
+    for key in ('out_time_us', 'out_time_ms'):
+        try:
+            return int(progress[key]) / 1000000.0
+        except (KeyError, ValueError):
+            pass
+    return None
+
+def subtitle_file(path, filename, m, sub_ext):
+    return os.path.join(path, filename + '.' + str(m["index"]) + '.' + m["tags"]["language"] + sub_ext)
+
+def remove_files(filepaths):
+    for filepath in filepaths:
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+def job_cost(job):
+    # Rough cost of a job in seconds of 1080p encoding; a remux only costs the I/O of copying the streams
+    duration = float(job['metaData']["format"]["duration"])
+    if job['vcodec'] == 'copy':
+        return duration * 0.02
+    for vs in job['metaData']["streams"]:
+        if vs.get("codec_type") == "video" and vs.get("width") and vs.get("height"):
+            return duration * int(vs["width"]) * int(vs["height"]) / (1920.0 * 1080.0)
+    return duration
+
+class FixerConfig(object):
+    # Every setting a Fixer reads. Defaults come from the options block above, and any of them can be
+    # overridden by keyword, e.g. FixerConfig(mode='speed', jobs=4, remover=False).
+    OPTIONS = ('outmode', 'outformat', 'remover', 'accept_ext', 'temp_path', 'temp_same_filesystem', 'mkvextract_exe',
+               'atomicparsley_exe', 'mkvpropedit_exe', 'strip_title', 'video_codec', 'video_type', 'audio_codec',
+               'audio_type', 'crf', 'vbr', 'extract_subtitle', 'subtitle_languages', 'text_subtitles', 'threads',
+               'additional_ffmpeg', 'deinterlace_ffmpeg', 'detect_interlace', 'idet_samples', 'idet_frames', 'jobs',
+               'probe_jobs', 'post_jobs', 'remux_jobs', 'remux_threads', 'lookahead', 'segments', 'segment_min_duration',
+               'state_path', 'probe_cache_entries', 'fast_probe', 'fast_probe_size', 'fast_probe_duration', 'watch_settle', 'metrics_log', 'metrics_textfile',
+               'progress_interval', 'stall_timeout', 'stall_retries', 'renditions', 'reads_per_device',
+               'min_free_space', 'space_margin', 'dedup', 'dedup_samples', 'dedup_block',
+               'target_speed', 'deadline')
+
+    def __init__(self, mode='quality', force=False, full_scan=False, order='listing', watch=False, use_probe_cache=True, **options):
+        for name in options:
+            if name not in self.OPTIONS:
+                raise TypeError("Unknown option " + name)
+        if mode not in ('quality', 'speed'):
+            raise ValueError("mode must be quality or speed")
+        if order not in ('listing', 'longest', 'shortest'):
+            raise ValueError("order must be listing, longest or shortest")
+        self.mode = mode
+        self.force = force
+        self.full_scan = full_scan
+        self.order = order
+        self.watch = watch
+        self.use_probe_cache = use_probe_cache
+        defaults = globals()
+        for name in self.OPTIONS:
+            setattr(self, name, options.get(name, defaults[name]))
+
+        if mode == 'speed':
+            self.crf = options.get('crf', "22")
+            self.additional_ffmpeg = options.get('additional_ffmpeg', '-preset superfast -movflags +faststart')
+        if 'outformat' not in options:
+            if self.outmode == 'mp4':
+                self.outformat = 'mp4'
+            elif self.outmode == 'mkv':
+                self.outformat = 'matroska'
+        self.subtitle_languages = self.subtitle_languages.lower()
+        if isinstance(self.renditions, str):
+            self.renditions = [Rendition.parse(text) for text in self.renditions.split()]
+        if len(set(r.suffix for r in self.renditions)) != len(self.renditions):
+            raise ValueError("Each rendition needs its own suffix")
+
+        if self.jobs < 1 or self.probe_jobs < 1 or self.post_jobs < 1 or self.remux_jobs < 1 or self.remux_threads < 1:
+            raise ValueError("jobs, probe_jobs, post_jobs, remux_jobs and remux_threads must be at least 1")
+        if self.threads < 0:
+            raise ValueError("threads must not be negative")
+        if self.segments < 0:
+            raise ValueError("segments must not be negative")
+        if self.reads_per_device < 0:
+            raise ValueError("reads_per_device must not be negative")
+        if self.stall_timeout < 0:
+            raise ValueError("stall_timeout must not be negative")
+        if self.target_speed < 0 or self.deadline < 0:
+            raise ValueError("target_speed and deadline must not be negative")
+        if self.deadline and watch:
+            raise ValueError("A deadline needs a batch to finish, use target_speed in watch mode")
+        if self.dedup_samples < 2 or self.dedup_block < 1:
+            raise ValueError("dedup_samples must be at least 2 and dedup_block at least 1")
+
+class FileResult(object):
+    # What happened to one input file. status is one of 'done', 'skipped', 'ignored', 'probe_fail' or 'failed';
+    # output is the converted file and renditions the extra outputs when status is 'done',
+    # metrics the FileMetrics of its stages.
+    def __init__(self, path, file, status, job=None, metrics=None):
+        self.path = path
+        self.file = file
+        self.status = status
+        self.metrics = metrics
+        self.output = None
+        self.renditions = []
+        self.vcodec = None
+        self.acodec = None
+        if job is not None:
+            self.vcodec = job['vcodec']
+            self.acodec = job['acodec']
+            if status == 'done':
+                self.output = job['output']
+                self.renditions = [out for r, temp, out in job['renditions'] if os.path.isfile(out)]
+
+    @property
+    def source(self):
+        return os.path.join(self.path, self.file)
+
+    def __repr__(self):
+        return 'FileResult(%r, %r)' % (self.source, self.status)
+
+class Fixer(object):
+    # Converts files and directory trees with one FixerConfig. The state its jobs share (saved state,
+    # thread budget, log buffering) lives here, so one instance can run any number of batches:
+    #
+    #     with Fixer(mode='speed', jobs=2) as fixer:
+    #         for result in fixer.run('/media/incoming'):
+    #             print(result.source, result.status, result.output)
+    def __init__(self, config=None, **options):
+        if config is None:
+            config = FixerConfig(**options)
+        elif options:
+            raise TypeError("Pass either a config or options, not both")
+        self.config = config
+        # Worker threads print their logs through this, it buffers them per file. sys.stdout gets its own
+        # stream back once close() has been called on every Fixer.
+        self.job_output = JobOutput.install()
+        self.closed = False
+        self.thread_budget = ThreadBudget(config.threads or os.cpu_count() or 1, config.jobs)
+        self.idet_pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.jobs)
+
+        self.state_db = StateDB(config.state_path)
+        self.probe_cache = None
+        if config.probe_cache_entries and config.use_probe_cache:
+            self.probe_cache = ProbeCache(self.state_db, config.probe_cache_entries)
+        # Everything that decides whether a file needs converting or what gets written next to it
+        self.sweep_manifest = SweepManifest(self.state_db, hashlib.sha1(json.dumps([
+            config.mode, config.outmode, config.outformat, config.accept_ext, config.video_codec, config.video_type,
+            config.audio_codec, config.audio_type, config.crf, config.additional_ffmpeg, config.strip_title,
+            config.extract_subtitle, config.subtitle_languages, config.text_subtitles, config.remover,
+            [repr(r) for r in config.renditions]]).encode('utf-8')).hexdigest())
+        self.capabilities = CapabilityCache(self.state_db)
+        self.recent_outputs = {}
+        log_path = config.metrics_log
+        if log_path is None:
+            log_path = os.path.join(config.state_path, "metrics.jsonl")
+        self.metrics = MetricsSink(log_path, config.metrics_textfile)
+        self.progress = ProgressBoard(self.job_output, config.progress_interval)
+        self.space = SpaceReservations(config.min_free_space)
+        self.reads = DeviceReads(config.reads_per_device)
+        self.speeds = SpeedTable(self.state_db)
+        # Set when a batch starts, see start_deadline()
+        self.deadline_at = None
+        self.content = None
+        if config.dedup:
+            # Everything that changes what an encode writes, a source converted with other settings is not reused
+            self.content = ContentIndex(self.state_db, json.dumps([
+                config.outformat, config.video_codec, config.video_type, config.audio_codec, config.audio_type, config.crf,
+                config.vbr, config.additional_ffmpeg, config.deinterlace_ffmpeg, config.detect_interlace, config.strip_title]))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.idet_pool.shutdown()
+        self.state_db.conn.close()
+        JobOutput.uninstall()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, result):
+        self.progress.remove(os.path.abspath(result.source))
+        try:
+            self.metrics.record(result)
+        except (OSError, ValueError) as e:
+            print("Unable to write metrics for " + result.file + ": %s" % e)
+
+    def start_deadline(self):
+        # config.deadline counts from the start of each batch, not from when the Fixer was made
+        if self.config.deadline:
+            self.deadline_at = time.monotonic() + self.config.deadline * 3600
+
+    def run(self, input):
+        # Returns a FileResult per file. With config.watch this never returns.
+        print("Entering File Processing...\n")
+        self.start_deadline()
+        if self.config.watch:
+            return self.watch_directory(input)
+        if os.path.isdir(input):
+            return self.process_directory(input)
+        if os.path.isfile(input):
+            return [self.process_file(os.path.dirname(input), os.path.basename(input))]
+        return []
+
+    def ffmpeg_log_options(self):
+        # -stats redraws a single terminal line, which is unreadable once several encodes share it
+        if self.config.jobs > 1 or self.config.remux_jobs > 1:
+            return '-v quiet -nostats'
+        return '-v quiet -stats'
+
+    def run_ffmpeg(self, inputs, outputs, on_progress=None, global_args=None):
+        # Runs ffmpeg reading its -progress reports as they come, so a job whose output position stops
+        # moving is killed instead of holding up the queue. on_progress(out_time, report) gets every report.
+        ff = ffmpy.FFmpeg(
+            global_options=self.ffmpeg_log_options().split(' ') + ['-progress', 'pipe:1'] + (global_args or []),
+            inputs=inputs,
+            outputs=outputs
+        )
+        proc = subprocess.Popen(ff._cmd, stdout=subprocess.PIPE)
+        try:
+            pending = b''
+            progress = {}
+            out_time = 0.0
+            moved = time.monotonic()
+            written = None
+            checked = moved
+            while True:
+                if select.select([proc.stdout], [], [], 1.0)[0]:
+                    data = os.read(proc.stdout.fileno(), 65536)
+                    if not data:
+                        break
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        key, sep, value = line.decode('utf-8', 'replace').strip().partition('=')
+                        if key != 'progress':
+                            progress[key] = value
+                            continue
+                        # A full report ends with progress=continue or progress=end
+                        seconds = progress_seconds(progress)
+                        if seconds is not None and seconds > out_time:
+                            out_time = seconds
+                            moved = time.monotonic()
+                        if on_progress:
+                            on_progress(out_time, progress)
+                        progress = {}
+                if self.config.stall_timeout and time.monotonic() - checked >= min(30, self.config.stall_timeout / 4.0):
+                    # After the last frame no reports come while the muxer finishes, e.g. the mp4 +faststart
+                    # pass moving the whole file up; output still being written counts as progress
+                    checked = time.monotonic()
+                    state = []
+                    for output in outputs:
+                        try:
+                            st = os.stat(output)
+                            state.append((st.st_size, st.st_mtime_ns))
+                        except OSError:
+                            state.append(None)
+                    if written is not None and state != written:
+                        moved = checked
+                    written = state
+                if self.config.stall_timeout and time.monotonic() - moved > self.config.stall_timeout:
+                    raise EncodeStalled("ffmpeg made no progress for " + str(self.config.stall_timeout) + " seconds at " + str(datetime.timedelta(seconds=int(out_time))))
+            proc.wait()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+        if proc.returncode != 0:
+            raise ffmpy.FFRuntimeError(ff.cmd, proc.returncode, None, None)
+        return (None, None)
+
+    def probe_file(self, filepath):
+        st = os.stat(filepath)
+        if self.probe_cache:
+            metaData = self.probe_cache.get(os.path.abspath(filepath), st)
+            if metaData is not None:
+                print("Using cached probe results...")
+                return metaData
+
+        metaData = None
+        if self.config.fast_probe:
+            tup_resp = ffmpy.FFprobe(
+                inputs={filepath: None},
+                global_options=[
+                    '-v', 'quiet',
+                    '-probesize', str(self.config.fast_probe_size),
+                    '-analyzeduration', str(self.config.fast_probe_duration),
+                    '-print_format', 'json',
+                    '-show_entries', 'stream=index,codec_type,codec_name,field_order,width,height,avg_frame_rate:stream_tags=language:stream_disposition=attached_pic:format=duration,bit_rate']
+            ).run(stdout=subprocess.PIPE)
+            metaData = json.loads(tup_resp[0].decode('utf-8'))
+            if not probe_complete(metaData):
+                print("Fast probe was incomplete, running full probe...")
+                metaData = None
+
+        if metaData is None:
+            tup_resp = ffmpy.FFprobe(
+                inputs={filepath: None},
+                global_options=[
+                    '-v', 'quiet',
+                    '-print_format', 'json',
+                    '-show_format', '-show_streams']
+            ).run(stdout=subprocess.PIPE)
+            metaData = json.loads(tup_resp[0].decode('utf-8'))
+
+        if self.probe_cache:
+            self.probe_cache.put(os.path.abspath(filepath), st, metaData)
+        return metaData
+
+    def idet_window(self, filepath, start):
+        # Returns (interlaced, progressive) frame counts from idet's multi frame detection
+        tup_resp = ffmpy.FFmpeg(
+            global_options='-hide_banner -nostats',
+            inputs={filepath: ['-ss', '%.3f' % start]},
+            outputs={'-': ['-map', '0:v:0', '-an', '-sn', '-frames:v', str(self.config.idet_frames), '-vf', 'idet', '-f', 'null']}
+        ).run(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        found = re.findall(r'Multi frame detection:\s*TFF:\s*(\d+)\s*BFF:\s*(\d+)\s*Progressive:\s*(\d+)', tup_resp[1].decode('utf-8', 'replace'))
+        if not found:
+            return (0, 0)
+        tff, bff, progressive = found[-1]
+        return (int(tff) + int(bff), int(progressive))
+
+    def detect_interlaced(self, filepath, metaData):
+        # Runs idet on a few short windows in parallel. None means idet could not tell.
+        st = os.stat(filepath)
+        if self.probe_cache:
+            interlaced = self.probe_cache.get_interlaced(os.path.abspath(filepath), st)
+            if interlaced is not None:
+                return interlaced
+        duration = float(metaData["format"]["duration"])
+        starts = [duration * (i + 1) / (self.config.idet_samples + 1) for i in range(self.config.idet_samples)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.idet_samples) as pool:
+            counts = list(pool.map(lambda start: self.idet_window(filepath, start), starts))
+        interlaced_frames = sum(c[0] for c in counts)
+        progressive_frames = sum(c[1] for c in counts)
+        if interlaced_frames + progressive_frames == 0:
+            return None
+        interlaced = interlaced_frames > progressive_frames
+        if self.probe_cache:
+            self.probe_cache.put_interlaced(os.path.abspath(filepath), st, interlaced)
+        return interlaced
+
+    def remember_probe(self, filepath, metaData):
+        # Call after rewriting a file in place whose streams did not change, so the next run still hits the cache
+        if self.probe_cache:
+            self.probe_cache.put(os.path.abspath(filepath), os.stat(filepath), metaData)
+
+    def note_output(self, filepath):
+        # Remember a file we just wrote, so watch mode does not pick it up again as a new download
+        if self.config.watch and os.path.isfile(filepath):
+            st = os.stat(filepath)
+            self.recent_outputs[os.path.abspath(filepath)] = (st.st_size, st.st_mtime_ns)
+
+    def strip_title_in_place(self, filepath):
+        if self.config.outmode == 'mkv':
+            striptitle_out = subprocess.check_output([self.config.mkvpropedit_exe, filepath, '--edit', 'info', '--delete', 'title'],stderr=subprocess.STDOUT)
+            return striptitle_out.decode('UTF-8')
+        try:
+            return "Removed " + str(strip_mp4_title(filepath)) + " title/comment atom(s)"
+        except ValueError as e:
+            print("Unable to edit atoms in place (%s), using AtomicParsley..." % e)
+            striptitle_out = subprocess.check_output([self.config.atomicparsley_exe, filepath,'--title','','--comment','','--overWrite'],stderr=subprocess.STDOUT)
+            return striptitle_out.decode('UTF-8')
+
+    def video_duration(self, filepath):
+        # Seconds of the first video stream, or of the whole file where the container keeps no stream duration
         tup_resp = ffmpy.FFprobe(
-            inputs={os.path.join(path, file): None},
-            global_options=[
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_format', '-show_streams']
+            inputs={filepath: None},
+            global_options=['-v', 'quiet', '-print_format', 'json', '-select_streams', 'v:0',
+                            '-show_entries', 'stream=duration:format=duration']
         ).run(stdout=subprocess.PIPE)
-    
-        metaData = json.loads(tup_resp[0].decode('utf-8'))
-    except Exception as file_info_ex:
-        print("File " + file + " is unable to be converted. Adding .PROBE_FAIL to file")
-        move_without_copying_stat(os.path.join(path, filename + "." + extension), os.path.join(path, filename + "." + extension + ".PROBE_FAIL"))
-        return
+        data = json.loads(tup_resp[0].decode('utf-8'))
+        for value in [vs.get("duration") for vs in data.get("streams", [])] + [data.get("format", {}).get("duration")]:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                pass
+        return None
 
-    vcodec = ''
-    acodec = ''
-    encode_crf = []
+    def encode_segmented(self, source, temp_file, metaData, acodec, encode_dif, encode_crf, video_args, sub_outputs, job_threads, progress_key):
+        # Encodes the video in parts in parallel, each decoded straight from the source with an accurate seek,
+        # then joins them with the concat demuxer. Audio and text subtitles take one separate pass of their own.
+        # Stream-copied parts would lose the open-GOP B-frames at every cut and drift against the audio, and
+        # the joined parts are still measured against the source: SegmentsDrifted means encode it in one go.
+        self.capabilities.require_format('matroska')
+        self.capabilities.require_format('mp4')
+        work_dir = temp_file + '.segments'
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        try:
+            duration = float(metaData["format"]["duration"])
+            frame = 1.0 / 25
+            for vs in metaData["streams"]:
+                if vs["index"] == main_video_index(metaData) and vs.get("avg_frame_rate", "0/0") not in ("0/0", "0/1"):
+                    num, den = vs["avg_frame_rate"].split('/')
+                    frame = float(den) / float(num)
+            # Cuts fall on frame boundaries, so neighbouring parts neither repeat nor skip a frame
+            starts = [round(duration * n / self.config.segments / frame) * frame for n in range(self.config.segments)]
+            parts = []
+            for n, start in enumerate(starts):
+                seek = ['-ss', '%.6f' % start]
+                if n + 1 < len(starts):
+                    seek.extend(['-t', '%.6f' % (starts[n + 1] - start)])
+                parts.append(('part%03d' % n, seek))
+            part_threads = max(1, job_threads // len(parts))
+            print("Encoding " + str(len(parts)) + " segments with " + str(part_threads) + " thread(s) each...")
+            part_times = {}
 
-    for vs in metaData["streams"]:
-        if "codec_type" in vs and vs["codec_type"] == "video":
-            if vs["codec_name"] == video_type:
-                vcodec = 'copy'
-                print("Video in stream " + str(vs["index"]) + " is " + video_type + ", no conversion needed...")
-            elif vs["codec_name"] != 'mjpeg':
-                vcodec = video_codec
-                if crf:
-                    encode_crf = ["-crf", "" + crf]
-                print("Video in stream " + str(vs["index"]) + " is currently " + color.BOLD + color.YELLOW + vs["codec_name"] + color.END + ". Converting to " + color.BOLD + color.YELLOW + video_type + color.END + "...")
-
-    encode_dif = []
-    for vs in metaData["streams"]:
-        if "codec_type" in vs and vs["codec_type"] == "video" and vcodec != 'copy':
-            if "field_order" in vs and vs["field_order"].find("progressive") == -1:
-                if deinterlace_ffmpeg:
-                    encode_dif = ["-vf", "" + deinterlace_ffmpeg]
-                print("Video in stream " + str(vs["index"]) + " is interlaced, deinterlacing...")
-            else:
-                print("Video in stream " + str(vs["index"]) + " is not interlaced, no deinterlacing needed...")
+            def part_progress(part, out_time, progress):
+                # The file's position is the sum of its parts'; their speed figures do not add up, so leave them out
+                part_times[part] = out_time
+                progress = dict(progress)
+                progress.pop('speed', None)
+                self.progress.update(progress_key, sum(part_times.values()), progress)
 
-    encode_vbr = []
-    for vs in metaData["streams"]:
-        if "codec_type" in vs and vs["codec_type"] == "audio":
-            if vs["codec_name"] == audio_type:
-                acodec = 'copy'
-                print("Audio in stream " + str(vs["index"]) + " is " + audio_type + ", no conversion needed...")
+            def encode_part(part_seek):
+                part, seek = part_seek
+                encoded = os.path.join(work_dir, part + '.mp4')
+                part_args = ['-y', '-f', 'mp4', '-map', '0:%d' % main_video_index(metaData), '-an', '-sn', '-dn']
+                part_args.extend(encode_dif)
+                part_args.extend(['-vcodec', self.config.video_codec])
+                part_args.extend(encode_crf)
+                part_args.extend(video_args)
+                part_args.extend(['-threads', str(part_threads)])
+                self.run_ffmpeg(
+                    inputs={source: seek},
+                    outputs={encoded: part_args},
+                    on_progress=lambda out_time, progress: part_progress(part, out_time, progress)
+                )
+                return encoded
+
+            audio_file = os.path.join(work_dir, 'audio.mka')
+            side_outputs = dict(sub_outputs)
+            if has_audio(metaData):
+                side_outputs[audio_file] = ['-y', '-f', 'matroska', '-vn', '-sn', '-dn', '-acodec', acodec]
+
+            def side_pass():
+                if side_outputs:
+                    self.run_ffmpeg(
+                        inputs={source: None},
+                        outputs=side_outputs
+                    )
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(parts) + 1) as pool:
+                side = pool.submit(side_pass)
+                encoded = list(pool.map(encode_part, parts))
+                side.result()
+
+            joined = sum(self.video_duration(part) or 0.0 for part in encoded)
+            expected = self.video_duration(source) or duration
+            if abs(joined - expected) > frame * len(parts):
+                raise SegmentsDrifted("The parts come to %.3fs of video but the source has %.3fs" % (joined, expected))
+
+            list_file = os.path.join(work_dir, 'concat.txt')
+            with open(list_file, 'w') as f:
+                for part in encoded:
+                    f.write("file '" + part.replace("'", "'\\''") + "'\n")
+
+            inputs = {list_file: ['-f', 'concat', '-safe', '0']}
+            final_args = ['-y', '-f', self.config.outformat, '-map', '0:v']
+            if has_audio(metaData):
+                inputs[audio_file] = None
+                final_args.extend(['-map', '1:a'])
+                if not self.config.strip_title:
+                    final_args.extend(['-map_metadata', '1'])
+            final_args.extend(['-c', 'copy'])
+            if self.config.outformat == 'mp4':
+                final_args.extend(['-movflags', '+faststart'])
+            print("Joining segments...")
+            return self.run_ffmpeg(
+                inputs=inputs,
+                outputs={temp_file: final_args}
+            )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def wanted_subtitles(self, metaData):
+        streams = []
+        for m in metaData["streams"]:
+            if 'subtitle' in m["codec_type"] and 'language' in m.get("tags", {}):
+                if m["tags"]["language"] in self.config.subtitle_languages.split(" "):
+                    streams.append(m)
+        return streams
+
+    def text_subtitle_outputs(self, path, filename, metaData):
+        # One extra ffmpeg output per text track, so every track comes out of a single read of the source
+        outputs = {}
+        for m in self.wanted_subtitles(metaData):
+            if m["codec_name"] in self.config.text_subtitles.split(" "):
+                if 'subrip' in m["codec_name"]:
+                    sub_format = 'copy'
+                else:
+                    sub_format = 'srt'
+                outputs[subtitle_file(path, filename, m, '.srt')] = ['-y', '-map', '0:' + str(m["index"]), '-c:s:0', sub_format]
+        return outputs
+
+    def plan_file(self, path, file, journal, metrics, renditions=None):
+        # Probe stage: returns (result, None) when the file needs no encode, else (None, job)
+        extension = decodeName(os.path.splitext(file)[1].replace(".", "").lower())
+        filename = decodeName(os.path.splitext(file)[0])
+
+        if extension in self.config.accept_ext and extension != "":
+            print(file + " is an acceptable extension. Checking file...")
+        else:
+            print(file + " is not an acceptable extension. Skipping...")
+            return 'ignored', None
+
+        previous = journal.previous_state(os.path.join(path, file))
+        if previous == 'done':
+            print(file + " was finished by an earlier run. Skipping...")
+            return 'skipped', None
+        if previous == 'failed':
+            print(file + " failed in an earlier run. Skipping...")
+            return 'failed', None
+
+        print('Processing Started: {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()))
+        journal.set(os.path.join(path, file), 'probing')
+        metrics.bytes_in = os.path.getsize(os.path.join(path, file))
+        try:
+            with metrics.stage('probe'):
+                metaData = self.probe_file(os.path.join(path, file))
+        except Exception as file_info_ex:
+            print("File " + file + " is unable to be converted. Adding .PROBE_FAIL to file")
+            move_without_copying_stat(os.path.join(path, filename + "." + extension), os.path.join(path, filename + "." + extension + ".PROBE_FAIL"))
+            journal.set(os.path.join(path, file), 'failed')
+            return 'probe_fail', None
+
+        vcodec = ''
+        acodec = ''
+        encode_crf = []
+
+        for vs in metaData["streams"]:
+            if "codec_type" in vs and vs["codec_type"] == "video":
+                if vs["codec_name"] == self.config.video_type:
+                    vcodec = 'copy'
+                    print("Video in stream " + str(vs["index"]) + " is " + self.config.video_type + ", no conversion needed...")
+                elif not is_cover(vs):
+                    vcodec = self.config.video_codec
+                    if self.config.crf:
+                        encode_crf = ["-crf", "" + self.config.crf]
+                    print("Video in stream " + str(vs["index"]) + " is currently " + color.BOLD + color.YELLOW + vs["codec_name"] + color.END + ". Converting to " + color.BOLD + color.YELLOW + self.config.video_type + color.END + "...")
+
+        idet_future = None
+        if self.config.detect_interlace and vcodec != 'copy':
+            idet_future = self.idet_pool.submit(self.detect_interlaced, os.path.join(path, file), metaData)
+
+        encode_vbr = []
+        for vs in metaData["streams"]:
+            if "codec_type" in vs and vs["codec_type"] == "audio":
+                if vs["codec_name"] == self.config.audio_type:
+                    acodec = 'copy'
+                    print("Audio in stream " + str(vs["index"]) + " is " + self.config.audio_type + ", no conversion needed...")
+                else:
+                    acodec = self.config.audio_codec
+                    if self.config.vbr:
+                        encode_vbr = ["-vbr", "" + self.config.vbr]
+                    print("Audio in stream " + str(vs["index"]) + " is currently " + color.BOLD + color.GREEN + vs["codec_name"] + color.END + ". Converting to " + color.BOLD + color.GREEN + self.config.audio_type + color.END +"...")
+
+        interlaced = None
+        if idet_future:
+            try:
+                with metrics.stage('probe'):
+                    interlaced = idet_future.result()
+            except Exception as e:
+                print("Interlace detection failed: %s" % e)
+            if interlaced is None:
+                print("Interlace detection was inconclusive, using field_order...")
             else:
-                acodec = audio_codec
-                if vbr:
-                    encode_vbr = ["-vbr", "" + vbr]
-                print("Audio in stream " + str(vs["index"]) + " is currently " + color.BOLD + color.GREEN + vs["codec_name"] + color.END + ". Converting to " + color.BOLD + color.GREEN + audio_type + color.END +"...")
-
-    if extension == outmode and vcodec == 'copy' and acodec == 'copy' and args.force == False:
-        print(file + " is already encoded properly. (" + outmode + " file and " + video_type + " / " + audio_type + ")\nNo conversion needed. Skipping...\n\n")
-        if strip_title:
-            print("Removing title metadata...")
-            striptitle_out = subprocess.check_output([atomicparsley_exe, os.path.join(path, filename + '.' + outmode),'--title','','--comment','','--overWrite'],stderr=subprocess.STDOUT)
-            print("Result: " + striptitle_out.decode('UTF-8'))
-        return
+                print("Interlace detection found the video " + ("interlaced" if interlaced else "progressive") + "...")
 
-    print("Using video codec: " + vcodec + " audio codec: " + acodec + " and Container format " + outformat + " for " + file)
-    print("Duration of current video: " + "{}".format(datetime.timedelta(seconds=float(metaData["format"]["duration"]))))
-    
-    filename = filename.replace("XVID", video_type)
-    filename = filename.replace("xvid", video_type)
-    enc_resp = ""
+        encode_dif = []
+        for vs in metaData["streams"]:
+            if "codec_type" in vs and vs["codec_type"] == "video" and vcodec != 'copy':
+                if interlaced is not None:
+                    stream_interlaced = interlaced and not is_cover(vs)
+                else:
+                    stream_interlaced = "field_order" in vs and vs["field_order"].find("progressive") == -1
+                if stream_interlaced:
+                    if self.config.deinterlace_ffmpeg:
+                        encode_dif = ["-vf", "" + self.config.deinterlace_ffmpeg]
+                    print("Video in stream " + str(vs["index"]) + " is interlaced, deinterlacing...")
+                else:
+                    print("Video in stream " + str(vs["index"]) + " is not interlaced, no deinterlacing needed...")
+
+        metrics.vcodec, metrics.acodec = vcodec, acodec
+        if "duration" in metaData.get("format", {}):
+            metrics.duration = float(metaData["format"]["duration"])
+
+        if renditions is None:
+            renditions = self.config.renditions
+        out_name = filename.replace("XVID", self.config.video_type).replace("xvid", self.config.video_type)
+        if any(out_name.endswith('.' + r.suffix) for r in renditions):
+            # This is a rendition written by an earlier run, not a source to make more of
+            renditions = []
+        if main_video_index(metaData) is None:
+            renditions = []
+        missing = [r for r in renditions if not os.path.isfile(os.path.join(path, out_name + '.' + r.suffix + '.' + self.config.outmode))]
+
+        if extension == self.config.outmode and vcodec == 'copy' and acodec == 'copy' and self.config.force == False and not missing:
+            print(file + " is already encoded properly. (" + self.config.outmode + " file and " + self.config.video_type + " / " + self.config.audio_type + ")\nNo conversion needed. Skipping...\n\n")
+            if self.config.strip_title:
+                print("Removing title metadata...")
+                with metrics.stage('title_strip'):
+                    print("Result: " + self.strip_title_in_place(os.path.join(path, filename + '.' + self.config.outmode)))
+                self.remember_probe(os.path.join(path, file), metaData)
+                self.note_output(os.path.join(path, file))
+            journal.set(os.path.join(path, file), 'done')
+            return 'skipped', None
+
+        renditions = missing
+        print("Using video codec: " + vcodec + " audio codec: " + acodec + " and Container format " + self.config.outformat + " for " + file)
+        if renditions:
+            print("Also writing rendition(s) " + ", ".join(r.suffix for r in renditions) + " from the same decode...")
+        print("Duration of current video: " + "{}".format(datetime.timedelta(seconds=float(metaData["format"]["duration"]))))
     
-    try:
-        ffargs = ['-y', '-f', outformat, '-acodec', acodec]
-        if encode_dif:
-            ffargs.extend(encode_dif)
-        ffargs.extend(['-vcodec', vcodec])
-        if encode_crf:
-            ffargs.extend(encode_crf)
-        if additional_ffmpeg:
-            ffargs.extend(additional_ffmpeg.split(" "))
-        if threads:
-            ffargs.extend(['-threads', str(threads)])
-
-        if temp_path:
-            print("Using temp_path...")
-            enc_resp = ffmpy.FFmpeg(
-                global_options="-v quiet -stats",
-                inputs={os.path.join(path, file): None},
-                outputs={os.path.join(temp_path, filename + ".temp"): ffargs}
-            ).run(stdout=subprocess.PIPE)
-            move_without_copying_stat(os.path.join(temp_path, filename + '.temp'), os.path.join(path, filename + '.' + outmode))
+        filename = filename.replace("XVID", self.config.video_type)
+        filename = filename.replace("xvid", self.config.video_type)
+
+        use_temp_path = self.config.temp_path
+        if self.config.temp_path and self.config.temp_same_filesystem and os.stat(self.config.temp_path).st_dev != os.stat(path).st_dev:
+            use_temp_path = None
+        if use_temp_path:
+            temp_file = os.path.join(self.config.temp_path, filename + ".temp")
         else:
-            print("Not using temp_path...")
-            enc_resp = ffmpy.FFmpeg(
-                global_options='-v quiet -stats',
-                inputs={os.path.join(path, file): None},
-                outputs={os.path.join(path, filename + u'.temp'): ffargs}
-            ).run(stdout=subprocess.PIPE)
-            move_without_copying_stat(os.path.join(path, filename + '.temp'), os.path.join(path, filename + '.' + outmode))
-
-        if strip_title:
-            print("Removing title metadata...")
-            striptitle_out = subprocess.check_output([atomicparsley_exe, os.path.join(path, filename + '.' + outmode),'--title','','--comment','','--overWrite'],stderr=subprocess.STDOUT)
-            print("Result: " + striptitle_out.decode('UTF-8'))
-
-    except Exception as e:
-        print("Error: %s" % e)
-        print("Removing temp file and skipping file")
-        if temp_path:
-            if os.path.isfile(os.path.join(temp_path, filename + '.temp')):
-                os.remove(os.path.join(temp_path, filename + '.temp'))
+            temp_file = os.path.join(path, filename + u'.temp')
+
+        fingerprint = None
+        if self.content and not self.config.force:
+            try:
+                with metrics.stage('probe'):
+                    fingerprint = content_fingerprint(os.path.join(path, file), self.config.dedup_samples, self.config.dedup_block)
+            except (OSError, ValueError) as e:
+                print("Unable to fingerprint " + file + ": %s" % e)
+
+        self.progress.add(os.path.abspath(os.path.join(path, file)), metrics.duration, vcodec != 'copy' or bool(renditions))
+        return None, {
+            'path': path,
+            'file': file,
+            'filename': filename,
+            'metaData': metaData,
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'encode_crf': encode_crf,
+            'encode_dif': encode_dif,
+            'previous': previous,
+            'use_temp_path': use_temp_path,
+            'temp_file': temp_file,
+            'output': os.path.join(path, filename + '.' + self.config.outmode),
+            'remux': vcodec == 'copy' and not renditions and main_video_index(metaData) is not None,
+            'renditions': [(r, temp_file + '.' + r.suffix, os.path.join(path, filename + '.' + r.suffix + '.' + self.config.outmode)) for r in renditions],
+            'journal': journal,
+            'metrics': metrics,
+            'reservation': None,
+            'fingerprint': fingerprint,
+            'claimed': False,
+            'encoded': False,
+            'sub_outputs': None,
+        }
+
+    def encode_job(self, job):
+        # Encode stage: writes the temp output, returns 'failed' or None to go on to finish_job
+        path, file, filename, metaData = job['path'], job['file'], job['filename'], job['metaData']
+        vcodec, acodec, encode_crf, encode_dif = job['vcodec'], job['acodec'], job['encode_crf'], job['encode_dif']
+        use_temp_path, temp_file, journal, metrics = job['use_temp_path'], job['temp_file'], job['journal'], job['metrics']
+        renditions, remux = job['renditions'], job['remux']
+        enc_resp = ""
+
+        if job['previous'] in ('moved', 'subtitles') and os.path.isfile(os.path.join(path, filename + '.' + self.config.outmode)):
+            print("Output was written by an earlier run, continuing after the encode...")
+            return None
+
+        if job['fingerprint'] and self.link_duplicate(job):
+            return None
+
+        if remux:
+            job_threads = self.config.remux_threads
+        elif vcodec == 'copy' and not renditions:
+            job_threads = 1
         else:
-            if os.path.isfile(os.path.join(path, filename + '.temp')):
-                os.remove(os.path.join(path, filename + '.temp'))
-        return
+            job_threads = self.thread_budget.share(encode_weight(metaData))
 
-    if extract_subtitle:
-        sub_resp = ""
-        print("\nExtracting Subtitles...\n")
-        for m in metaData["streams"]:
-            if 'subtitle' in m["codec_type"]:
-                if 'tags' in m:
-                    if 'language' in m["tags"]:
-                        if m["tags"]["language"] in subtitle_languages.split(" "):
-                            try:
-                                if 'subrip' in m["codec_name"]:
-                                    sub_format = 'copy'
-                                    sub_ext = '.srt'
-                                elif mkvextract_exe and 'hdmv_pgs' in m["codec_name"]:
-                                    mkvextract_out = subprocess.check_output([mkvextract_exe, 'tracks', os.path.join(path, file),
-                                                             str(m["index"]) + ':' + os.path.join(path, filename + '.'
-                                                             + str(m["index"]) + '.' + m["tags"]["language"] + '.sup')],stderr=subprocess.STDOUT)
-                                    continue
-                                else:
-                                    sub_format = 'srt'
-                                    sub_ext = '.srt'
-                                enc_resp = ffmpy.FFmpeg(
-                                    global_options='-v quiet -stats',
+        video_args = self.config.additional_ffmpeg.split(" ") if self.config.additional_ffmpeg else []
+        if vcodec != 'copy' and self.config.video_codec == 'libx264':
+            preset = self.choose_preset(job)
+            if preset:
+                video_args = with_preset(video_args, preset)
+            metrics.preset = preset_of(video_args)
+        segmented = self.config.segments > 1 and vcodec != 'copy' and not renditions and float(metaData["format"]["duration"]) >= self.config.segment_min_duration
+
+        sub_outputs = {}
+        try:
+            self.capabilities.require_format(self.config.outformat)
+            if vcodec != 'copy' or renditions:
+                self.capabilities.require_encoder(self.config.video_codec, "Video")
+            if acodec != 'copy' or (remux and any(vs["codec_name"] != self.config.audio_type for vs in metaData["streams"] if vs.get("codec_type") == "audio")):
+                self.capabilities.require_encoder(self.config.audio_codec, "Audio")
+
+            if remux:
+                print("Video is copied, mapping every stream and converting only the audio that needs it...")
+                ffargs = self.remux_args(job)
+            else:
+                ffargs = ['-y', '-f', self.config.outformat, '-acodec', acodec]
+                if encode_dif and not renditions:
+                    ffargs.extend(encode_dif)
+                ffargs.extend(['-vcodec', vcodec])
+                if encode_crf:
+                    ffargs.extend(encode_crf)
+                ffargs.extend(video_args)
+            if self.config.strip_title:
+                ffargs.extend(['-metadata', 'title=', '-metadata', 'comment='])
+
+            if use_temp_path:
+                print("Using temp_path...")
+            elif self.config.temp_path:
+                print("temp_path is on another filesystem, encoding next to the output...")
+            else:
+                print("Not using temp_path...")
+
+            outputs = {temp_file: ffargs}
+            graph_args = []
+            if renditions:
+                graph_args, rendition_outputs = self.rendition_outputs(job, ffargs)
+                outputs.update(rendition_outputs)
+            if self.config.extract_subtitle:
+                sub_outputs = self.text_subtitle_outputs(path, filename, metaData)
+                if sub_outputs:
+                    print("Extracting " + str(len(sub_outputs)) + " text subtitle track(s) in the same pass...")
+                outputs.update(sub_outputs)
+
+            job['reservation'] = self.space.reserve(self.space_claims(job))
+            journal.set(os.path.join(path, file), 'encoding', temp_file)
+            read_slot = self.reads.acquire(os.path.join(path, file))
+            if remux:
+                # Bound by disk speed rather than cores, so these stay out of the encoders' thread budget
+                print("Using " + str(job_threads) + " threads...")
+            else:
+                job_threads = self.thread_budget.acquire(job_threads)
+                print("Using " + str(job_threads) + " of " + str(self.thread_budget.total) + " threads...")
+            try:
+                for output_args in [ffargs] + [outputs[temp] for r, temp, out in renditions]:
+                    output_args.extend(['-threads', str(job_threads)])
+                progress_key = os.path.abspath(os.path.join(path, file))
+                attempt = 0
+                timed = True
+                while True:
+                    try:
+                        with metrics.stage('encode'):
+                            if segmented:
+                                enc_resp = self.encode_segmented(os.path.join(path, file), temp_file, metaData, acodec,
+                                                            encode_dif, encode_crf, video_args, sub_outputs or {}, job_threads, progress_key)
+                            else:
+                                enc_resp = self.run_ffmpeg(
                                     inputs={os.path.join(path, file): None},
-                                    outputs={os.path.join(path, filename + '.' + str(m["index"]) + '.' + m["tags"]["language"] + sub_ext): ['-y', '-map', '0:' + str(m["index"]), '-c:s:0', sub_format]}
-                                ).run(stdout=subprocess.PIPE)
-                                print("")
-                            except Exception as e:
-                                print("Error: %s" % e)
-                                print("Deleting subtitle.")
-                                if os.path.isfile(os.path.join(path, filename + '.' + str(m["index"]) + '.' + m["tags"]["language"] + sub_ext)):
-                                    os.remove(os.path.join(path, filename + '.' + str(m["index"]) + '.' + m["tags"]["language"] + sub_ext))
-
-    if remover and filename + '.' + outmode != file:
-        print("Deleting original file: " + file)
-        os.remove(os.path.join(path, file))
+                                    outputs=outputs,
+                                    on_progress=lambda out_time, progress: self.progress.update(progress_key, out_time, progress),
+                                    global_args=graph_args
+                                )
+                        break
+                    except SegmentsDrifted as e:
+                        print("Error: %s" % e)
+                        print("Encoding it again in one piece...")
+                        segmented = False
+                        timed = False
+                    except EncodeStalled as e:
+                        if attempt == self.config.stall_retries:
+                            raise
+                        attempt += 1
+                        print("Error: %s" % e)
+                        print("Killed the stalled encode, starting it again...")
+                    except Exception as e:
+                        if not sub_outputs or self.progress.position(progress_key) > 5:
+                            # Only a failure while ffmpeg was still setting up can come from a subtitle output,
+                            # one later on (a full disk, a broken source) would fail the second encode too
+                            raise
+                        # A subtitle track ffmpeg cannot convert should not cost the whole encode
+                        print("Error: %s" % e)
+                        print("Encoding again without the subtitle tracks, they are extracted on their own afterwards...")
+                        remove_files(sub_outputs)
+                        for sub_file in sub_outputs:
+                            del outputs[sub_file]
+                        sub_outputs = None
+            finally:
+                if not remux:
+                    self.thread_budget.release(job_threads)
+                self.reads.release(read_slot)
+
+        except Exception as e:
+            print("Error: %s" % e)
+            print("Removing temp file and skipping file")
+            remove_files([temp_file] + [temp for r, temp, out in renditions])
+            remove_files(sub_outputs or [])
+            journal.set(os.path.join(path, file), 'failed')
+            return 'failed'
+
+        if metrics.preset and not renditions and not segmented and timed and metrics.speed():
+            # Renditions and split encodes run at speeds of their own, only plain encodes say what a preset manages
+            self.speeds.record(*speed_bucket(metaData), preset=metrics.preset, factor=metrics.speed())
+        job['encoded'] = True
+        job['sub_outputs'] = sub_outputs
+        return None
+
+    def choose_preset(self, job):
+        # The slowest x264 preset measured to encode this kind of source at its share of the speed needed,
+        # from target_speed or what is left of the deadline. None keeps the configured preset.
+        needed = self.config.target_speed
+        if self.deadline_at is not None:
+            left = self.deadline_at - time.monotonic()
+            if left <= 0:
+                print("The deadline has passed, using preset " + X264_PRESETS[0][0] + "...")
+                return X264_PRESETS[0][0]
+            needed = max(needed, self.progress.encode_backlog() / left)
+        if not needed:
+            return None
+        share = needed / self.config.jobs
+        codec, height = speed_bucket(job['metaData'])
+        kind = str(codec) + " " + str(height) + "p"
+        estimates = [(preset, self.speeds.estimate(codec, height, preset)) for preset, relative in X264_PRESETS]
+        if estimates[0][1] is None:
+            print("No encode speed measured yet for " + kind + ", keeping the configured preset...")
+            return None
+        for preset, speed in reversed(estimates):
+            if speed >= share:
+                print("Using preset " + preset + ", about %.2fx realtime for %s against the %.2fx each of %d encoders needs..."
+                      % (speed, kind, share, self.config.jobs))
+                return preset
+        print("Even preset " + estimates[0][0] + " (about %.2fx realtime for %s) is short of the %.2fx each of %d encoders needs, using it..."
+              % (estimates[0][1], kind, share, self.config.jobs))
+        return estimates[0][0]
+
+    def link_duplicate(self, job):
+        # Gives the job the outputs of an identical source converted earlier. Returns False when it has to be
+        # encoded, in which case it holds the fingerprint's claim until finish_job or the pipeline drops it.
+        outputs = self.content.claim(job['fingerprint'])
+        if outputs is None:
+            job['claimed'] = True
+            return False
+        wanted = [('', job['output'])] + [(repr(r), out) for r, temp, out in job['renditions']]
+        if any(key not in outputs or os.path.abspath(outputs[key]) == os.path.abspath(out) for key, out in wanted):
+            return False
+        linked = []
+        try:
+            with job['metrics'].stage('move'):
+                for key, out in wanted:
+                    how = link_output(outputs[key], out)
+                    linked.append(out)
+                    print("Same content as " + outputs[key] + ", " + how + " it to " + out + " instead of encoding...")
+        except OSError as e:
+            print("Unable to link the earlier output: %s" % e)
+            print("Encoding it instead...")
+            remove_files(linked)
+            return False
+        job['journal'].set(os.path.join(job['path'], job['file']), 'moved')
+        return True
+
+    def release_job(self, job):
+        # Gives back what a job still holds once it has left the pipeline, whether it finished or not
+        self.space.release(job['reservation'])
+        job['reservation'] = None
+        if job['claimed']:
+            self.content.finish(job['fingerprint'])
+            job['claimed'] = False
+
+    def space_claims(self, job):
+        # The files a job will write and their estimated sizes. The output needs space of its own
+        # only when the temp file is on another disk and has to be copied over.
+        metaData = job['metaData']
+        estimate = estimate_output_size(metaData, job['metrics'].bytes_in) * self.config.space_margin
+        height = max([int(vs.get("height") or 0) for vs in metaData["streams"] if vs.get("codec_type") == "video"] + [0])
+        files = [(job['temp_file'], job['output'], estimate)]
+        for r, temp, out in job['renditions']:
+            scale = min(1.0, float(r.height) / height) ** 2 if r.height and height else 1.0
+            files.append((temp, out, estimate * scale))
+        claims = []
+        for temp, out, size in files:
+            claims.append((temp, int(size)))
+            if os.stat(os.path.dirname(os.path.abspath(temp))).st_dev != os.stat(os.path.dirname(os.path.abspath(out))).st_dev:
+                claims.append((out, int(size)))
+        return claims
+
+    def remux_args(self, job):
+        # Output args for a file whose video is already right. Every stream kept is mapped explicitly, so no
+        # audio track is dropped and no cover art is taken for the video; only audio in another codec is converted.
+        metaData = job['metaData']
+        ffargs = ['-y', '-f', self.config.outformat, '-map', '0:%d' % main_video_index(metaData), '-c:v', 'copy']
+        audio = [vs for vs in metaData["streams"] if vs.get("codec_type") == "audio"]
+        for n, vs in enumerate(audio):
+            ffargs.extend(['-map', '0:%d' % vs["index"]])
+            if vs["codec_name"] == self.config.audio_type:
+                ffargs.extend(['-c:a:%d' % n, 'copy'])
+            else:
+                ffargs.extend(['-c:a:%d' % n, self.config.audio_codec])
+        if self.config.outformat == 'matroska':
+            if any(vs.get("codec_type") == "subtitle" for vs in metaData["streams"]):
+                ffargs.extend(['-map', '0:s', '-c:s', 'copy'])
+        else:
+            # mp4 only holds text subtitles, as mov_text
+            for vs in self.wanted_subtitles(metaData):
+                if vs["codec_name"] in self.config.text_subtitles.split(" "):
+                    ffargs.extend(['-map', '0:%d' % vs["index"], '-c:s', 'mov_text'])
+        if self.config.outformat == 'mp4':
+            ffargs.extend(['-movflags', '+faststart'])
+        return ffargs
+
+    def rendition_outputs(self, job, ffargs):
+        # The video is decoded and deinterlaced once, then split between the main output and every rendition.
+        # Returns the -filter_complex arguments and the rendition outputs, and maps the main output onto the graph.
+        metaData, vcodec, acodec, encode_dif = job['metaData'], job['vcodec'], job['acodec'], job['encode_dif']
+        renditions = job['renditions']
+        video = main_video_index(metaData)
+        # A copied main output keeps the source bitstream and needs no branch of its own
+        branches = len(renditions) + (0 if vcodec == 'copy' else 1)
+        labels = ['[v%d]' % i for i in range(branches)]
+        chain = []
+        if encode_dif and vcodec != 'copy':
+            chain.append(encode_dif[1])
+        chain.append('split=' + str(branches))
+        graph = ['[0:%d]' % video + ','.join(chain) + ''.join(labels)]
+
+        if vcodec == 'copy':
+            ffargs.extend(['-map', '0:%d' % video])
+        else:
+            ffargs.extend(['-map', labels.pop(0)])
+        ffargs.extend(['-map', '0:a?'])
+
+        outputs = {}
+        for (r, temp, out), label in zip(renditions, labels):
+            if r.height:
+                scaled = label.replace('[v', '[s')
+                graph.append(label + "scale=-2:'min(ih,%d)'" % r.height + scaled)
+                label = scaled
+            args = ['-y', '-f', self.config.outformat, '-map', label, '-map', '0:a:0?', '-acodec', acodec, '-vcodec', self.config.video_codec]
+            if r.crf or self.config.crf:
+                args.extend(['-crf', r.crf or self.config.crf])
+            extra = self.config.additional_ffmpeg.split(" ") if self.config.additional_ffmpeg else []
+            if r.preset:
+                extra = with_preset(extra, r.preset)
+            args.extend(extra)
+            if self.config.strip_title:
+                args.extend(['-metadata', 'title=', '-metadata', 'comment='])
+            outputs[temp] = args
+        return ['-filter_complex', ';'.join(graph)], outputs
+
+    def finish_job(self, job):
+        # Post stage: moves the output into place, extracts the remaining subtitles and removes the original
+        path, file, filename, metaData = job['path'], job['file'], job['filename'], job['metaData']
+        temp_file, sub_outputs, journal, metrics = job['temp_file'], job['sub_outputs'], job['journal'], job['metrics']
+
+        if job['encoded']:
+            try:
+                with metrics.stage('move'):
+                    commit_output(temp_file, os.path.join(path, filename + '.' + self.config.outmode))
+                    for r, temp, out in job['renditions']:
+                        commit_output(temp, out)
+                self.space.release(job['reservation'])
+                job['reservation'] = None
+            except Exception as e:
+                print("Error: %s" % e)
+                print("Removing temp file and skipping file")
+                remove_files([temp_file] + [temp for r, temp, out in job['renditions']])
+                remove_files(sub_outputs or [])
+                journal.set(os.path.join(path, file), 'failed')
+                return 'failed'
+            journal.set(os.path.join(path, file), 'moved')
+
+        if self.config.extract_subtitle:
+            journal.set(os.path.join(path, file), 'subtitles')
+            with metrics.stage('subtitles'):
+                sub_resp = ""
+                print("\nExtracting Subtitles...\n")
+                if sub_outputs is None:
+                    # The encode ran in an earlier run, so the text tracks still need their own pass
+                    sub_outputs = self.text_subtitle_outputs(path, filename, metaData)
+                    if sub_outputs:
+                        try:
+                            enc_resp = self.run_ffmpeg(
+                                inputs={os.path.join(path, file): None},
+                                outputs=sub_outputs
+                            )
+                            print("")
+                        except Exception as e:
+                            print("Error: %s" % e)
+                            print("Deleting subtitles.")
+                            remove_files(sub_outputs)
+                pgs_tracks = []
+                for m in self.wanted_subtitles(metaData):
+                    if m["codec_name"] in self.config.text_subtitles.split(" "):
+                        continue
+                    if self.config.mkvextract_exe and 'hdmv_pgs' in m["codec_name"]:
+                        pgs_tracks.append(str(m["index"]) + ':' + subtitle_file(path, filename, m, '.sup'))
+                    else:
+                        print("Subtitle in stream " + str(m["index"]) + " is " + m["codec_name"] + ", which cannot be written as text. Skipping...")
+                if pgs_tracks:
+                    # mkvextract takes any number of id:file pairs and writes them all in one pass over the file
+                    try:
+                        mkvextract_out = subprocess.check_output([self.config.mkvextract_exe, 'tracks', os.path.join(path, file)] + pgs_tracks,stderr=subprocess.STDOUT)
+                    except Exception as e:
+                        print("Error: %s" % e)
+                        print("Deleting subtitles.")
+                        remove_files([track.split(':', 1)[1] for track in pgs_tracks])
+
+        if self.config.remover and filename + '.' + self.config.outmode != file:
+            print("Deleting original file: " + file)
+            with metrics.stage('delete'):
+                os.remove(os.path.join(path, file))
     
-    print('Processing Started: {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()))
+        for output in [job['output']] + [out for r, temp, out in job['renditions']]:
+            if os.path.isfile(output):
+                metrics.bytes_out += os.path.getsize(output)
+                self.note_output(output)
+        if job['claimed']:
+            outputs = dict([('', job['output'])] + [(repr(r), out) for r, temp, out in job['renditions']])
+            if all(os.path.isfile(output) for output in outputs.values()):
+                self.content.finish(job['fingerprint'], outputs)
+                job['claimed'] = False
+        journal.set(os.path.join(path, file), 'done')
+        if filename + '.' + self.config.outmode != file:
+            journal.set(os.path.join(path, filename + '.' + self.config.outmode), 'done')
+        print('Processing Finished: {:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()))
+        return 'done'
 
+    def process_file(self, path, file, renditions=None):
+        # renditions is a list of Rendition profiles to use instead of the configured ones
+        journal = JobJournal(self.state_db, os.path.join(path, file))
+        journal.recover()
+        metrics = FileMetrics()
+        # A file handed over on its own is a batch of its own
+        self.start_deadline()
+        result, job = self.plan_file(path, file, journal, metrics, renditions)
+        if job is not None:
+            try:
+                result = self.encode_job(job) or self.finish_job(job)
+            finally:
+                self.release_job(job)
+        journal.clear()
+        result = FileResult(path, file, result, job, metrics)
+        self.record(result)
+        return result
 
-def process_directory(path):
-    if os.path.isfile(os.path.join(path, ".noconvert")):
-        return
-    for file in sorted(os.listdir(path)):
-        filepath = os.path.join(path, file)
-        if os.path.isdir(filepath):
-            process_directory(filepath)
-        elif os.path.isfile(filepath):
-            process_file(path, file)
+    def walk_directory(self, path, tracker):
+        if os.path.isfile(os.path.join(path, ".noconvert")):
+            return
+        if not (self.config.full_scan or self.config.force):
+            subdirs = self.sweep_manifest.unchanged_subdirs(path)
+            if subdirs is not None:
+                print("Skipping unchanged directory " + path)
+                for subdir in subdirs:
+                    if os.path.isdir(os.path.join(path, subdir)):
+                        for entry in self.walk_directory(os.path.join(path, subdir), tracker):
+                            yield entry
+                return
+        subdirs = []
+        for file in sorted(os.listdir(path)):
+            filepath = os.path.join(path, file)
+            if os.path.isdir(filepath):
+                subdirs.append(file)
+                for entry in self.walk_directory(filepath, tracker):
+                    yield entry
+            elif os.path.isfile(filepath):
+                tracker.add_file(path)
+                yield (path, file)
+        tracker.listed(path, subdirs)
+
+    def process_directory(self, path):
+        self.start_deadline()
+        journal = JobJournal(self.state_db, path)
+        journal.recover()
+        tracker = SweepTracker(self.sweep_manifest)
+        results = []
+
+        def file_done(result):
+            results.append(result)
+            tracker.finished(result.path, result.status)
 
+        # A deadline needs the whole batch on the progress board to know the speed it takes
+        hold = self.config.order != 'listing' or bool(self.config.deadline)
+        pipeline = Pipeline(self, journal, file_done, hold=hold)
+        # In listing order the walk stays lazy on huge trees, submit() blocks once enough files are queued ahead
+        for dirpath, file in self.walk_directory(path, tracker):
+            pipeline.submit(dirpath, file)
+        if hold:
+            pipeline.dispatch({'longest': True, 'shortest': False}.get(self.config.order))
+        pipeline.wait()
+        journal.clear()
+        return results
 
-if os.path.isdir(args.input):
-    process_directory(args.input)
-elif os.path.isfile(args.input):
-    process_file(os.path.dirname(args.input), os.path.basename(args.input))
+    def watch_directory(self, path, on_result=None):
+        if not os.path.isdir(path):
+            raise ValueError("Watch mode needs a directory, not " + path)
+        if self.config.deadline:
+            raise ValueError("A deadline needs a batch to finish, use target_speed in watch mode")
+        journal = JobJournal(self.state_db, path, keep_finished=False)
+        journal.recover()
+        watcher = InotifyWatcher()
+        watcher.add_tree(path)
+        print("Watching " + path + " for new files...\n")
+
+        # Files a crashed run had not finished go through the same settle check as new ones
+        settling = dict((filepath, None) for filepath in journal.unfinished())
+        active = set()
+        lock = threading.Lock()
+
+        def job_done(result):
+            with lock:
+                active.discard(result.source)
+            if on_result:
+                on_result(result)
+
+        pipeline = Pipeline(self, journal, job_done)
+        while True:
+            for dirpath, name, mask in watcher.read_events(1.0):
+                filepath = os.path.join(dirpath, name)
+                if mask & InotifyWatcher.IN_ISDIR:
+                    # A directory moved in may already hold finished files, which raise no events of their own
+                    watcher.add_tree(filepath)
+                    for subpath, dirnames, filenames in os.walk(filepath):
+                        for file in filenames:
+                            settling[os.path.join(subpath, file)] = None
+                elif not mask & InotifyWatcher.IN_CREATE:
+                    settling[filepath] = None
+
+            now = time.time()
+            for filepath in list(settling):
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    del settling[filepath]
+                    continue
+                state = (st.st_size, st.st_mtime_ns)
+                if settling[filepath] is None or settling[filepath][0] != state:
+                    settling[filepath] = (state, now)
+                    continue
+                if now - settling[filepath][1] < self.config.watch_settle:
+                    continue
+                del settling[filepath]
+                key = os.path.abspath(filepath)
+                if self.recent_outputs.get(key) == state:
+                    del self.recent_outputs[key]
+                    continue
+                with lock:
+                    if filepath in active:
+                        continue
+                    active.add(filepath)
+                pipeline.submit(os.path.dirname(filepath), os.path.basename(filepath))
+
+def main():
+    parser = argparse.ArgumentParser(description='Simple mp4 converter')
+    parser.add_argument('-i','--input', help='Input file name/path', required=True)
+    parser.add_argument('-m','--mode',help='Processing mode', choices=['quality', 'speed'], required=True)
+    parser.add_argument('-f','--force', type=str2bool, nargs='?', const=True, default=False, help="Force reprocess")
+    parser.add_argument('-j','--jobs', type=int, default=jobs, help='Number of files to encode at once')
+    parser.add_argument('--probe-jobs', type=int, default=probe_jobs, help='Number of files probed at once ahead of the encoders')
+    parser.add_argument('--remux-jobs', type=int, default=remux_jobs, help='Number of files whose video is only copied converted at once')
+    parser.add_argument('--reads-per-device', type=int, default=reads_per_device, help='Most jobs reading sources from the same disk at once, 0 for no limit')
+    parser.add_argument('--post-jobs', type=int, default=post_jobs, help='Number of finished encodes post-processed at once')
+    parser.add_argument('-t','--threads', type=int, default=threads, help='Cores shared by all running ffmpeg jobs, 0 uses all')
+    parser.add_argument('--no-probe-cache', action='store_true', help='Always run ffprobe instead of using cached results')
+    parser.add_argument('--full-scan', action='store_true', help='List every directory even if it is unchanged since the last run')
+    parser.add_argument('-s','--segments', type=int, default=segments, help='Split long encodes into this many parts encoded in parallel')
+    parser.add_argument('--detect-interlace', action='store_true', default=detect_interlace, help='Sample the video with idet to decide on deinterlacing')
+    parser.add_argument('-o','--order', choices=['listing', 'longest', 'shortest'], default='listing', help='Order to encode files in: as listed, or by estimated cost after probing them all')
+    parser.add_argument('-w','--watch', action='store_true', help='Stay running and convert new files as they appear in the input directory')
+    parser.add_argument('--metrics-log', default=metrics_log, help='File to append a JSON line of stage timings to for every file, off by default')
+    parser.add_argument('--metrics-textfile', default=metrics_textfile, help='Prometheus textfile collector file to keep batch totals in')
+    parser.add_argument('-r','--renditions', default=renditions, help='Extra outputs from the same decode, as space separated suffix:height:crf:preset entries')
+    parser.add_argument('--target-speed', type=float, default=target_speed, help='Realtime factor all encoders together must keep up, picks the x264 preset per file from measured speeds')
+    parser.add_argument('--deadline', type=float, default=deadline, help='Hours the whole batch must be encoded in, probes every file first and picks the x264 preset per file from measured speeds')
+    parser.add_argument('--dedup', action='store_true', default=dedup, help='Link the output of an identical source converted earlier instead of encoding it again')
+    parser.add_argument('--stall-timeout', type=int, default=stall_timeout, help='Kill and retry an encode that makes no progress for this many seconds, 0 disables')
+    args = parser.parse_args()
+
+    if args.watch and not os.path.isdir(args.input):
+        parser.error('--watch needs a directory as input')
+    try:
+        config = FixerConfig(mode=args.mode, force=args.force, full_scan=args.full_scan, order=args.order,
+                             watch=args.watch, use_probe_cache=not args.no_probe_cache, jobs=args.jobs,
+                             probe_jobs=args.probe_jobs, post_jobs=args.post_jobs, remux_jobs=args.remux_jobs,
+                             reads_per_device=args.reads_per_device, threads=args.threads,
+                             segments=args.segments, detect_interlace=args.detect_interlace,
+                             metrics_log=args.metrics_log, metrics_textfile=args.metrics_textfile,
+                             stall_timeout=args.stall_timeout, renditions=args.renditions, dedup=args.dedup,
+                             target_speed=args.target_speed, deadline=args.deadline)
+    except ValueError as e:
+        parser.error(str(e))
 
+    with Fixer(config) as fixer:
+        fixer.run(args.input)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import shutil
+import subprocess
+import argparse
+import ffmpy
+import json
+import datetime
+import tempfile
+import time
+
+import theFixer3
+
+# Edit options here ##################################################
+fixture_path = os.path.expanduser(u"~/.cache/theFixer/bench")   #Directory generated fixtures are kept in between runs
+duration = 30                                               #Seconds of video in each fixture
+size = '1280x720'                                           #Frame size of the fixtures
+copies = 2                                                  #Copies of each fixture in the batch, so parallel jobs have work to share
+
+## END OPTIONS - DO NOT EDIT BELOW THIS LINE UNLESS YOU KNOW WHAT YOU ARE DOING ##
+
+SUBTITLES = u"""1
+00:00:01,000 --> 00:00:04,000
+Benchmark subtitle one
+
+2
+00:00:05,000 --> 00:00:09,000
+Benchmark subtitle two
+"""
+
+def fixtures(duration, size):
+    # Name, inputs and output args of each fixture; inputs without options are files next to the fixtures.
+    # ffmpeg has no PGS encoder and cannot draw text subtitles as bitmaps, so the MKV carries text tracks
+    # only: an SRT, an ASS to convert and a language that is not extracted.
+    video = 'testsrc2=size=%s:rate=25:duration=%d' % (size, duration)
+    fields = 'testsrc2=size=%s:rate=50:duration=%d' % (size, duration)
+    audio = 'sine=frequency=440:sample_rate=48000:duration=%d' % duration
+    return [
+        ('h264_aac.mp4', [(video, ['-f', 'lavfi']), (audio, ['-f', 'lavfi'])],
+         ['-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-metadata', 'title=Benchmark', '-movflags', '+faststart', '-f', 'mp4']),
+        ('mpeg2_interlaced.ts', [(fields, ['-f', 'lavfi']), (audio, ['-f', 'lavfi'])],
+         ['-vf', 'tinterlace=mode=interleave_top,setfield=tff', '-c:v', 'mpeg2video', '-b:v', '8M', '-flags', '+ilme+ildct',
+          '-top', '1', '-c:a', 'mp2', '-f', 'mpegts']),
+        ('xvid.avi', [(video, ['-f', 'lavfi']), (audio, ['-f', 'lavfi'])],
+         ['-c:v', 'mpeg4', '-vtag', 'XVID', '-q:v', '5', '-c:a', 'ac3', '-f', 'avi']),
+        ('subtitles.mkv', [(video, ['-f', 'lavfi']), (audio, ['-f', 'lavfi']), ('subtitles.srt', None)],
+         ['-map', '0:v', '-map', '1:a', '-map', '2:s', '-map', '2:s', '-map', '2:s',
+          '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'ac3', '-c:s:0', 'srt', '-c:s:1', 'ass', '-c:s:2', 'srt',
+          '-metadata:s:s:0', 'language=eng', '-metadata:s:s:1', 'language=eng', '-metadata:s:s:2', 'language=fre', '-f', 'matroska']),
+    ]
+
+def generate_fixtures(directory, duration, size):
+    # Fixtures are kept per duration and size, and only made again when one is missing
+    directory = os.path.join(directory, '%ds_%s' % (duration, size))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    srt = os.path.join(directory, 'subtitles.srt')
+    if not os.path.isfile(srt):
+        with open(srt, 'w') as f:
+            f.write(SUBTITLES)
+    paths = []
+    for name, inputs, args in fixtures(duration, size):
+        path = os.path.join(directory, name)
+        paths.append(path)
+        if os.path.isfile(path):
+            continue
+        print("Generating " + path + "...")
+        ffmpy.FFmpeg(
+            global_options='-v error -y',
+            inputs=dict((source if opts else os.path.join(directory, source), opts) for source, opts in inputs),
+            outputs={path + '.partial': args}
+        ).run(stdout=subprocess.PIPE)
+        os.replace(path + '.partial', path)
+    return paths
+
+def run_mode(mode, paths, copies, options, single, verbose):
+    # Converts a fresh copy of the fixtures with an empty state directory, so every run probes and encodes from scratch
+    work = tempfile.mkdtemp(prefix='theFixerBench.')
+    try:
+        batch = os.path.join(work, 'batch')
+        os.makedirs(batch)
+        for n in range(copies):
+            for path in paths:
+                name, ext = os.path.splitext(os.path.basename(path))
+                shutil.copy(path, os.path.join(batch, name + '_' + str(n) + ext))
+        sources = sorted(os.listdir(batch))
+
+        stdout = sys.stdout
+        if not verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            # Closed even on an error, so JobOutput is gone before the devnull stream under it is closed
+            with theFixer3.Fixer(mode=mode, state_path=os.path.join(work, 'state'), temp_path=work,
+                                 metrics_log="", progress_interval=0, **options) as fixer:
+                start = time.monotonic()
+                if single:
+                    results = [fixer.process_file(batch, source) for source in sources]
+                else:
+                    results = fixer.process_directory(batch)
+                wall = time.monotonic() - start
+        finally:
+            if not verbose:
+                sys.stdout.close()
+            sys.stdout = stdout
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    statuses = {}
+    stages = {}
+    for result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+        for name, seconds in result.metrics.stages.items():
+            stages[name] = stages.get(name, 0.0) + seconds
+    # Skipped files are only probed, so they count towards files/s but not towards the video converted or bytes read
+    converted = [result for result in results if result.status == 'done']
+    media = sum(result.metrics.duration or 0.0 for result in converted)
+    return {
+        'mode': mode,
+        'files': len(results),
+        'wall': wall,
+        'files_per_sec': len(results) / wall,
+        'media_seconds': media,
+        'realtime': media / wall,
+        'bytes_read': sum(result.metrics.bytes_in for result in converted),
+        'bytes_written': sum(result.metrics.bytes_out for result in converted),
+        'statuses': statuses,
+        'stages': stages,
+    }
+
+def report(result, baseline=None):
+    print(result['mode'] + ": " + str(result['files']) + " files in %.1fs, %.3f files/s, %.2fx realtime, converted files read %.1f MB and wrote %.1f MB"
+          % (result['wall'], result['files_per_sec'], result['realtime'], result['bytes_read'] / 1e6, result['bytes_written'] / 1e6))
+    print("    results: " + ", ".join(status + "=" + str(count) for status, count in sorted(result['statuses'].items())))
+    print("    stages: " + ", ".join(name + "=%.1fs" % seconds for name, seconds in sorted(result['stages'].items())))
+    if baseline and baseline['realtime']:
+        print("    against baseline: %.2fx the files/s, %.2fx the realtime factor"
+              % (result['files_per_sec'] / baseline['files_per_sec'], result['realtime'] / baseline['realtime']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark theFixer3 on generated fixtures')
+    parser.add_argument('-m','--mode', choices=['quality', 'speed'], action='append', help='Mode to benchmark, may be given twice (default both)')
+    parser.add_argument('-d','--duration', type=int, default=duration, help='Seconds of video in each fixture')
+    parser.add_argument('--size', default=size, help='Frame size of the fixtures')
+    parser.add_argument('-c','--copies', type=int, default=copies, help='Copies of each fixture in the batch')
+    parser.add_argument('-j','--jobs', type=int, default=theFixer3.jobs, help='Number of files to encode at once')
+    parser.add_argument('--fixtures', default=fixture_path, help='Directory generated fixtures are kept in')
+    parser.add_argument('--single', action='store_true', help='Convert the files one by one with process_file instead of as a directory')
+    parser.add_argument('-o','--output', help='Write the results as JSON to this file')
+    parser.add_argument('-b','--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('-v','--verbose', action='store_true', help='Show the log of every file')
+    args = parser.parse_args()
+
+    if args.duration < 1 or args.copies < 1:
+        parser.error('--duration and --copies must be at least 1')
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = dict((result['mode'], result) for result in json.load(f)['results'])
+
+    paths = generate_fixtures(args.fixtures, args.duration, args.size)
+    results = []
+    for mode in args.mode or ['speed', 'quality']:
+        result = run_mode(mode, paths, args.copies, {'jobs': args.jobs}, args.single, args.verbose)
+        report(result, baseline.get(mode))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': datetime.datetime.now().isoformat(), 'duration': args.duration, 'size': args.size,
+                       'copies': args.copies, 'jobs': args.jobs, 'single': args.single, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()